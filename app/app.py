@@ -1,15 +1,30 @@
 from dotenv import load_dotenv
 load_dotenv()
 
-import requests
 import os
 import json
 import random
-from flask import Flask, render_template, request, jsonify, url_for
+from flask import Flask, render_template, request, jsonify, url_for, make_response, Response, stream_with_context, g
 import datetime # For timestamps in logs
-import ipaddress
+import threading
+import time
+import atexit
+import queue
+
+from app.assets import AssetPipeline
+from app.audit import compare, exact_report, simulate
+from app.discord_delivery import DiscordDelivery
+from app.geo import DEFAULT_GEO_API_URL, GeoLocator
+from app.history import InvalidCursor, read_after, read_history
+from app.live_feed import LiveFeed
+from app.metrics import ERRORS_TOTAL, REQUEST_SECONDS, ROLLS_TOTAL, SamplingProfiler, render_metrics, server_timing_header, stage
+from app.narrative_log import NarrativeLogWriter
+from app.shared_state import open_shared_state
+from app.stats import RollStats, summarize_stats
+from app.tables import SECONDARY_EFFECT_TABLES, compile_crit_data, compile_fumble_data, report_coverage, secondary_type_for
 
 app = Flask(__name__)
+asset_pipeline = AssetPipeline(app)
 
 # --- Determine log file path ---
 LOG_STORAGE_DIR = os.environ.get('LOG_STORAGE_DIR', '.')
@@ -27,6 +42,36 @@ except OSError as e:
     NARRATIVE_LOG_FILE_PATH = os.path.join('.', LOG_FILENAME)
     app.logger.info(f"Fallback log file path is now: {NARRATIVE_LOG_FILE_PATH}")
 
+# --- Shared state (tables, recent rolls, geolocation cache; prepared by the gunicorn master before fork) ---
+TABLE_FILES = [os.path.join(os.path.dirname(__file__), name) for name in ("critical_hits_master.json", "fumbles_master.json")]
+TABLE_RELOAD_INTERVAL = float(os.environ.get('TABLE_RELOAD_INTERVAL', 2))
+shared_state = open_shared_state(TABLE_FILES)
+atexit.register(shared_state.remove)
+
+# --- Narrative log writer (group commits off the request thread) ---
+narrative_log = NarrativeLogWriter(NARRATIVE_LOG_FILE_PATH, recent=shared_state.recent,
+                                   flush_interval=float(os.environ.get('LOG_FLUSH_INTERVAL', 0.2)),
+                                   fsync_policy=os.environ.get('LOG_FSYNC', 'never'),
+                                   rotate=os.environ.get('LOG_ROTATE', 'size'),
+                                   max_bytes=int(os.environ.get('LOG_ROTATE_MAX_BYTES', 10 * 1024 * 1024)))
+atexit.register(narrative_log.close)
+
+# --- Roll stats (aggregates folded in as batches are committed, shared by all workers) ---
+roll_stats = RollStats(os.path.splitext(NARRATIVE_LOG_FILE_PATH)[0] + ".stats.json")
+narrative_log.add_listener(roll_stats.record)
+
+# --- Live roll feed (Server-Sent Events) ---
+live_feed = LiveFeed(NARRATIVE_LOG_FILE_PATH, poll_interval=float(os.environ.get('STREAM_POLL_INTERVAL', 0.5)))
+narrative_log.add_listener(live_feed.poke)
+STREAM_HEARTBEAT_SECONDS = float(os.environ.get('STREAM_HEARTBEAT_SECONDS', 15))
+STREAM_MAX_CLIENTS = int(os.environ.get('STREAM_MAX_CLIENTS', 48))
+
+# --- Discord delivery (queued, coalesced, rate-limit aware) ---
+discord_delivery = DiscordDelivery(os.environ.get('DISCORD_WEBHOOK_URL'),
+                                   coalesce_window=float(os.environ.get('DISCORD_COALESCE_WINDOW', 1.0)),
+                                   shared=shared_state.deliveries)
+atexit.register(discord_delivery.close)
+
 # --- Lists for Narrative Logging ---
 RANDOM_DESCRIPTORS = [
     "an intrepid adventurer", "a curious scholar", "a daring rogue",
@@ -37,105 +82,72 @@ RANDOM_DESCRIPTORS = [
 ]
 
 # --- Load Data ---
-def load_json(filename):
-    json_path = os.path.join(os.path.dirname(__file__), filename)
-    try:
-        with open(json_path) as f:
-            return json.load(f)
-    except FileNotFoundError:
-        app.logger.error(f"Error: JSON file not found at {json_path}")
-        return {}
-    except json.JSONDecodeError:
-        app.logger.error(f"Error: Could not decode JSON from {json_path}")
-        return {}
-
-# Load data files
-CRIT_DATA = load_json("critical_hits_master.json")
-FUMBLE_DATA = load_json("fumbles_master.json")
-
-# Initial data integrity checks (simplified for brevity in this example)
-if not CRIT_DATA: app.logger.warning("CRIT_DATA is empty or failed to load.")
-if not FUMBLE_DATA: app.logger.warning("FUMBLE_DATA is empty or failed to load.")
-
-
-# --- Geolocation Helper ---
-def get_geolocation(ip_address):
-    # Use a placeholder for IP addresses in log messages to avoid logging the actual IP.
-    ip_display_for_logs = "[IP REDACTED]"
-
-    if not ip_address: return {"city": "an unknown void", "regionName": "the ether"}
-    try:
-        ip_obj = ipaddress.ip_address(ip_address)
-        if ip_obj.is_loopback: return {"city": "their cozy terminal", "regionName": "the local machine"}
-        if ip_obj.is_private: return {"city": "their local sanctum", "regionName": "the home network"}
-        if ip_obj in ipaddress.ip_network('100.64.0.0/10', strict=False): return {"city": "their secure Tailnet", "regionName": "a private dimension"}
-    except ValueError:
-        # Handle cases like "localhost" string which is not a valid IP for ipaddress module
-        if isinstance(ip_address, str) and ip_address.lower() == "localhost":
-            return {"city": "their cozy terminal", "regionName": "the local machine"}
-        # Log with the placeholder instead of the actual potentially invalid IP string
-        app.logger.warning(f"Invalid IP format for geolocation: {ip_display_for_logs}")
-        return {"city": "an unidentifiable nexus", "regionName": "a glitch in the matrix"}
-    
-    # For external API calls, the actual ip_address is still used.
-    try:
-        url = f"http://ip-api.com/json/{ip_address}?fields=status,message,city,regionName,query"
-        response_geo = requests.get(url, timeout=3)
-        response_geo.raise_for_status()
-        data = response_geo.json()
-        
-        api_message = data.get('message', 'Unknown ip-api.com error')
-        # Sanitize api_message if it might contain the IP (ip-api.com puts the IP in the 'query' field of its response)
-        # and sometimes in the 'message' field for errors.
-        if data.get("query") and isinstance(api_message, str) and data.get("query") in api_message:
-            api_message = api_message.replace(data.get("query"), ip_display_for_logs)
-
-        if data.get("status") == "success":
-            return {"city": data.get("city", "unknown city"), "regionName": data.get("regionName", "uncharted territory")}
-        
-        app.logger.warning(f"Geo API error for {ip_display_for_logs}: {api_message}")
-        return {"city": "parts unknown", "regionName": "mysterious land"}
-
-    except requests.exceptions.Timeout:
-        app.logger.warning(f"Geo request timed out for {ip_display_for_logs}")
-        return {"city": "realm beyond reach", "regionName": "mists of time"}
-    except requests.exceptions.RequestException as e:
-        # Sanitize exception string if it's likely to contain the URL with the IP
-        error_message = str(e)
-        if isinstance(ip_address, str) and ip_address in error_message: # Check if the original IP is in the error string
-            error_message = error_message.replace(ip_address, ip_display_for_logs)
-        app.logger.warning(f"Error fetching geo for {ip_display_for_logs}: {error_message}")
-        return {"city": "digital realm", "regionName": "boundless interwebs"}
-    except json.JSONDecodeError:
-        app.logger.warning(f"Failed to decode geo JSON for {ip_display_for_logs}")
-        return {"city": "garbled signal", "regionName": "static void"}
-    except Exception as e:
-        # Sanitize generic exception messages as well
-        error_message_generic = str(e)
-        if isinstance(ip_address, str) and ip_address in error_message_generic:
-             error_message_generic = error_message_generic.replace(ip_address, ip_display_for_logs)
-        # exc_info=True will log the stack trace. Standard tracebacks don't show all local variables by default,
-        # but the exception message itself (str(e)) is sanitized above.
-        app.logger.error(f"Generic geo error for {ip_display_for_logs}: {error_message_generic}", exc_info=True)
-        return {"city": "place beyond perception", "regionName": "the void"}
+# The master JSON lives once in shared memory. Each worker compiles its lookups from the active version,
+# and recompiles (with a new DATA_VERSION and INDEX_ETAG) when any process publishes a reload.
+_index_html_cache = {}
+_tables_lock = threading.Lock()
+TABLES_GENERATION = None
+
+def install_tables():
+    global CRIT_DATA, FUMBLE_DATA, CRIT_TABLES, FUMBLE_TABLES, SV_DAMAGE_TYPES, SV_MAGIC_SUBTYPES, DATA_VERSION, INDEX_ETAG, TABLES_GENERATION
+    if shared_state.tables.generation == TABLES_GENERATION: return
+    with _tables_lock:
+        generation, (crit_data, fumble_data), version = shared_state.tables.read()
+        if generation == TABLES_GENERATION: return
+        if not crit_data: app.logger.warning("CRIT_DATA is empty or failed to load.")
+        if not fumble_data: app.logger.warning("FUMBLE_DATA is empty or failed to load.")
+        # Compile every table into a dense face-indexed lookup once, so coverage problems surface here rather than per roll
+        crit_tables, fumble_tables = compile_crit_data(crit_data), compile_fumble_data(fumble_data)
+        if report_coverage(crit_tables, fumble_tables): app.logger.warning("Roll tables loaded with coverage issues; affected faces will report no result.")
+        CRIT_DATA, FUMBLE_DATA, CRIT_TABLES, FUMBLE_TABLES = crit_data, fumble_data, crit_tables, fumble_tables
+        # Index page inputs, derived once per data version
+        SV_DAMAGE_TYPES = sorted([k for k in CRIT_DATA.get('Sterling Vermin', {}) if not k.startswith('magic:')])
+        SV_MAGIC_SUBTYPES = sorted([k for k in CRIT_DATA.get('Sterling Vermin', {}) if k.startswith('magic:')])
+        DATA_VERSION = version
+        INDEX_ETAG = f"{DATA_VERSION}-{asset_pipeline.version}"
+        _index_html_cache.clear()
+        TABLES_GENERATION = generation
+        app.logger.info(f"Using roll tables version {DATA_VERSION} (generation {generation})")
+
+install_tables()
+
+@app.before_request
+def refresh_tables():
+    shared_state.tables.maybe_reload(TABLE_FILES, TABLE_RELOAD_INTERVAL)
+    install_tables()
+
+
+# --- Geolocation ---
+geolocator = GeoLocator(api_url=os.environ.get('GEO_API_URL', DEFAULT_GEO_API_URL),
+                        max_entries=int(os.environ.get('GEO_CACHE_SIZE', 1024)),
+                        ttl=int(os.environ.get('GEO_CACHE_TTL', 3600)),
+                        negative_ttl=int(os.environ.get('GEO_NEGATIVE_CACHE_TTL', 300)),
+                        max_pending=int(os.environ.get('GEO_MAX_PENDING', 64)),
+                        shared=shared_state.geo)
 
 # --- Helper Functions ---
 def resolve_roll(roll_value, table):
-    if not isinstance(table, dict): app.logger.warning(f"Invalid table to resolve_roll: {type(table)}"); return "Invalid table data."
+    if table is None or not hasattr(table, 'lookup'): app.logger.warning(f"Invalid table to resolve_roll: {type(table)}"); return "Invalid table data."
     try:
-        val = int(roll_value)
-        for key, result_text in table.items():
-            if '-' in key: start, end = map(int, key.split('-')); شرط = start <= val <= end
-            else: شرط = str(val) == key
-            if شرط: return result_text
+        result_text = table.lookup(int(roll_value))
+        if result_text is not None: return result_text
     except (ValueError, TypeError) as e: app.logger.error(f"Error resolving roll {roll_value}: {e}", exc_info=True)
-    app.logger.warning(f"No result for roll {roll_value} in table {str(table)[:200] + '...' if len(str(table)) > 200 else table}")
+    app.logger.warning(f"No result for roll {roll_value} in table {table.name}")
     return "No result found for this roll in the table."
 
 
 # --- Main Roll Logic & Narrative Logging ---
-def get_roll_result_and_log(payload, client_ip=None):
-    geo_info = get_geolocation(client_ip)
+SECONDARY_PROMPT_TEXT = {"minor": "Minor Injury!", "major": "Major Injury!", "insanity": "Insanity!"}
+
+def die_faces_for(payload):
+    if payload.get('rollContext', 'primary') == 'secondary': return 20
+    if payload.get('rollType') == 'crit' and payload.get('critSource', 'Sterling Vermin') not in ["Questionable Arcana", "BCoydog"]: return 20
+    return 100
+
+
+def resolve_roll_payload(payload, roll_value=None):
+    """Roll (or use the pre-drawn roll_value) and resolve one roll request into the response dict."""
+    if roll_value is None: roll_value = random.randint(1, die_faces_for(payload))
     response = {"status": "success", "rollValue": None, "resultText": None, "description": None, "effect": None, 
                   "isSecondaryPrompt": False, "secondaryPromptText": None, "secondaryType": None, 
                   "primaryRollValueForSecondary": payload.get('primaryRollValue'), 
@@ -161,9 +173,9 @@ def get_roll_result_and_log(payload, client_ip=None):
                 response["selectedCritSource"] = crit_source_from_payload
 
                 if crit_source_from_payload in ["Questionable Arcana", "BCoydog"]:
-                    response["dieType"], response["numDice"], roll_value = "d100", 1, random.randint(1, 100)
+                    response["dieType"], response["numDice"] = "d100", 1
                 else: # Sterling Vermin
-                    response["dieType"], response["numDice"], roll_value = "d20", 1, random.randint(1, 20)
+                    response["dieType"], response["numDice"] = "d20", 1
                 response["rollValue"] = roll_value
                 
                 crit_damage_key = (damage_type.lower().strip() if damage_type else None)
@@ -171,7 +183,7 @@ def get_roll_result_and_log(payload, client_ip=None):
                     crit_damage_key = magic_subtype if damage_type == 'magic' else damage_type
                     crit_damage_key = (crit_damage_key.lower().strip() if crit_damage_key else 'slashing')
                 
-                source_tables = CRIT_DATA.get(crit_source_from_payload, {})
+                source_tables = CRIT_TABLES.get(crit_source_from_payload, {})
                 if not source_tables: response.update({"status": "error", "errorMessage": f"Invalid Crit source: {crit_source_from_payload}"})
                 else:
                     table_data = source_tables.get(crit_damage_key)
@@ -189,18 +201,16 @@ def get_roll_result_and_log(payload, client_ip=None):
                             else: response["description"], response["effect"], response["resultText"] = res_text, "Details not separated.", None
                         else: response["resultText"] = res_text
 
-                        if isinstance(text_for_injury_check, str):
-                            if "minor injury" in text_for_injury_check.lower(): response.update({"isSecondaryPrompt": True, "secondaryPromptText": "Minor Injury!", "secondaryType": "minor"})
-                            elif "major injury" in text_for_injury_check.lower(): response.update({"isSecondaryPrompt": True, "secondaryPromptText": "Major Injury!", "secondaryType": "major"})
-                            elif "insanity" in text_for_injury_check.lower(): response.update({"isSecondaryPrompt": True, "secondaryPromptText": "Insanity!", "secondaryType": "insanity"})
+                        secondary_type = secondary_type_for(text_for_injury_check)
+                        if secondary_type: response.update({"isSecondaryPrompt": True, "secondaryPromptText": SECONDARY_PROMPT_TEXT[secondary_type], "secondaryType": secondary_type})
                     else: response.update({"status": "error", "errorMessage": f"Invalid damage type '{crit_damage_key}' for {crit_source_from_payload} Crits."})
 
             elif roll_type_from_payload == 'fumble':
-                response["dieType"], response["numDice"], roll_value = "d100", 1, random.randint(1, 100)
+                response["dieType"], response["numDice"] = "d100", 1
                 response["rollValue"] = roll_value
                 response["selectedFumbleType"] = fumble_source_from_payload
                 
-                fumble_src_tables = FUMBLE_DATA.get(fumble_source_from_payload, {})
+                fumble_src_tables = FUMBLE_TABLES.get(fumble_source_from_payload, {})
                 if not fumble_src_tables: 
                     response.update({"status": "error", "errorMessage": f"Invalid fumble source: {fumble_source_from_payload}"})
                 else:
@@ -224,12 +234,12 @@ def get_roll_result_and_log(payload, client_ip=None):
                     # END BUG FIX MODIFICATION for fumble key selection
 
                     if key_to_use:
-                        f_list = fumble_src_tables.get(key_to_use, [])
+                        f_list = fumble_src_tables.get(key_to_use)
                         
-                        # Fallback logic for BCoydog if the specific key ('melee', 'ranged', 'magic') yields no list
-                        # or if key_to_use was invalid and resulted in empty f_list for BCoydog
+                        # Fallback logic for BCoydog if the specific key ('melee', 'ranged', 'magic') yields no table
+                        # or if key_to_use was invalid and resulted in no f_list for BCoydog
                         if not f_list and fumble_source_from_payload == 'BCoydog':
-                            general_fumbles = fumble_src_tables.get('general', [])
+                            general_fumbles = fumble_src_tables.get('general')
                             if general_fumbles:
                                 app.logger.info(f"Fumble key '{key_to_use}' for BCoydog resulted in empty list or was invalid. Falling back to 'general' fumbles.")
                                 f_list = general_fumbles
@@ -238,73 +248,174 @@ def get_roll_result_and_log(payload, client_ip=None):
                         if not f_list: 
                             response.update({"status": "error", "errorMessage": f"No fumble entries for {fumble_source_from_payload} - {key_to_use} (including fallback)." })
                         else:
-                            found = False
-                            for entry in f_list:
-                                rr_str = entry.get('roll'); match = False
-                                if not rr_str: continue
-                                try:
-                                    if '-' in rr_str: l, h = map(int, rr_str.split('-')); match = l <= roll_value <= h
-                                    else: match = int(rr_str) == roll_value
-                                except ValueError: app.logger.warning(f"Malformed roll '{rr_str}' in {fumble_source_from_payload}"); continue
-                                if match: response.update({"description": entry.get('description', 'N/A'), "effect": entry.get('effect', 'N/A')}); found = True; break
-                            if not found: response.update({"description": f"No matching {fumble_source_from_payload} fumble for {roll_value} in {key_to_use}.", "effect": "No additional effect."})
+                            entry = f_list.lookup(roll_value)
+                            if entry: response.update({"description": entry.get('description', 'N/A'), "effect": entry.get('effect', 'N/A')})
+                            else: response.update({"description": f"No matching {fumble_source_from_payload} fumble for {roll_value} in {key_to_use}.", "effect": "No additional effect."})
                     # If key_to_use was None (e.g. from undefined fumble source), error is already set.
             else: response.update({"status": "error", "errorMessage": f"Invalid primary roll type: {roll_type_from_payload}"})
 
         elif roll_context == 'secondary':
-            response["dieType"], response["numDice"], roll_value = "d20", 1, random.randint(1, 20)
+            response["dieType"], response["numDice"] = "d20", 1
             response["rollValue"] = roll_value
-            sec_map = {'minor': 'minor_injuries', 'major': 'major_injuries', 'insanity': 'insanities'}
-            sec_key = sec_map.get(roll_type_from_payload)
+            sec_key = SECONDARY_EFFECT_TABLES.get(roll_type_from_payload)
             if sec_key:
-                eff_data = CRIT_DATA.get('effects_tables', {}).get(sec_key, {})
+                eff_data = CRIT_TABLES.get('effects_tables', {}).get(sec_key)
                 if eff_data: response["secondaryResultText"] = resolve_roll(roll_value, eff_data)
                 else: response.update({"status": "error", "errorMessage": f"Secondary table '{sec_key}' not found."})
             else: response.update({"status": "error", "errorMessage": f"Invalid secondary roll type: {roll_type_from_payload}"})
         else: response.update({"status": "error", "errorMessage": f"Invalid roll context: {roll_context}"})
     except Exception as e:
-        app.logger.error(f"Error processing roll: {e}", exc_info=True)
+        app.logger.error(f"Error processing roll: {e}", exc_info=True); ERRORS_TOTAL.inc(where="roll")
         response.update({"status": "error", "errorMessage": f"An internal error occurred: {str(e)}"})
 
-    if response["status"] == "success":
-        desc = random.choice(RANDOM_DESCRIPTORS); city = geo_info.get("city", "city?"); region = geo_info.get("regionName", "region?")
-        rval = response.get("rollValue"); t_name = "Unknown Table"; res_log = "N/A"
-        if roll_context == 'primary':
-            if roll_type_from_payload == 'crit':
-                src = response.get("selectedCritSource", "?"); dmg_key = (payload.get('damageType') or "?").lower()
-                if src == 'Sterling Vermin':
-                    sv_sub = payload.get('magicSubtype'); sv_dmg = payload.get('damageType')
-                    dmg_key = (sv_sub if sv_dmg == 'magic' else sv_dmg or 'slashing').lower()
-                t_name = f"{src} Crit ({dmg_key.title()})"
-                res_log = response.get("description") + " Effect: " + response.get("effect") if response.get("description") and response.get("effect") else response.get("resultText", "N/A")
-            elif roll_type_from_payload == 'fumble':
-                src = response.get("selectedFumbleType", "?"); atk = response.get("selectedAttackType", "?") # atk will be 'melee', 'ranged', 'magic' for BCoydog
-                t_name = f"{src} Fumble ({atk.title() if atk else 'Unknown'})"; # .title() for display
-                d, e = response.get("description", ""), response.get("effect", "")
-                res_log = f"{d} Effect: {e}".strip() if e else d
-        elif roll_context == 'secondary': t_name = f"{roll_type_from_payload.title()} Effect"; res_log = response.get("secondaryResultText", "N/A")
-        
-        d_words = desc.split(' '); art = d_words[0].capitalize() if d_words[0].lower() in ["a","an"] else ("An" if desc[0].lower() in 'aeiou' else "A")
-        d_noun = ' '.join(d_words[1:]) if d_words[0].lower() in ["a","an"] else desc
-        log_entry = f"{art} {d_noun} from {city}, {region} rolled {rval} on {t_name}, resulting in: \u201c{str(res_log).strip()}\u201d"
-        if response.get("isSecondaryPrompt") and not response.get("secondaryResultText"): log_entry += " (Bonus roll pending...)"
+    count_roll(roll_context, roll_type_from_payload, response["selectedCritSource"] if roll_type_from_payload == 'crit' else fumble_source_from_payload, response["status"])
+    return response
+
+
+def count_roll(roll_context, roll_type, source, status):
+    """Bump ROLLS_TOTAL; labels come from the client, so anything unknown is counted as "other" (bounded series, never unhashable)."""
+    known = lambda value, names: value if isinstance(value, str) and value in names else ("other" if value else "")
+    try:
+        tables = CRIT_TABLES if roll_type == 'crit' else (FUMBLE_TABLES if roll_type == 'fumble' else {})
+        ROLLS_TOTAL.inc(context=known(roll_context, ('primary', 'secondary')), status=status,
+                        roll_type=known(roll_type, ('crit', 'fumble', *SECONDARY_EFFECT_TABLES)), source=known(source, tables))
+    except Exception as e: app.logger.error(f"Could not count roll: {e}", exc_info=True)
+
+
+def compose_narrative(payload, response, descriptor, geo_info, pending=None):
+    """Build the one-line narrative for a successful roll; pending defaults to whether a bonus roll is still owed."""
+    roll_context = payload.get('rollContext', 'primary'); roll_type_from_payload = payload.get('rollType')
+    city = geo_info.get("city", "city?"); region = geo_info.get("regionName", "region?")
+    rval = response.get("rollValue"); t_name = "Unknown Table"; res_log = "N/A"
+    if roll_context == 'primary':
+        if roll_type_from_payload == 'crit':
+            src = response.get("selectedCritSource", "?"); dmg_key = (payload.get('damageType') or "?").lower()
+            if src == 'Sterling Vermin':
+                sv_sub = payload.get('magicSubtype'); sv_dmg = payload.get('damageType')
+                dmg_key = (sv_sub if sv_dmg == 'magic' else sv_dmg or 'slashing').lower()
+            t_name = f"{src} Crit ({dmg_key.title()})"
+            res_log = response.get("description") + " Effect: " + response.get("effect") if response.get("description") and response.get("effect") else response.get("resultText", "N/A")
+        elif roll_type_from_payload == 'fumble':
+            src = response.get("selectedFumbleType", "?"); atk = response.get("selectedAttackType", "?") # atk will be 'melee', 'ranged', 'magic' for BCoydog
+            t_name = f"{src} Fumble ({atk.title() if atk else 'Unknown'})"; # .title() for display
+            d, e = response.get("description", ""), response.get("effect", "")
+            res_log = f"{d} Effect: {e}".strip() if e else d
+    elif roll_context == 'secondary': t_name = f"{roll_type_from_payload.title()} Effect"; res_log = response.get("secondaryResultText", "N/A")
+
+    d_words = descriptor.split(' '); art = d_words[0].capitalize() if d_words[0].lower() in ["a","an"] else ("An" if descriptor[0].lower() in 'aeiou' else "A")
+    d_noun = ' '.join(d_words[1:]) if d_words[0].lower() in ["a","an"] else descriptor
+    log_entry = f"{art} {d_noun} from {city}, {region} rolled {rval} on {t_name}, resulting in: \u201c{str(res_log).strip()}\u201d"
+    if pending is None: pending = response.get("isSecondaryPrompt") and not response.get("secondaryResultText")
+    if pending: log_entry += " (Bonus roll pending...)"
+    return log_entry
+
+
+def log_rolls_when_located(geo_future, rolls, descriptor):
+    """Write narrative lines for [(payload, response, pending)] as one grouped append once geolocation resolves."""
+    timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    # Snapshot the responses (callers may still mutate them); chained results are logged as their own lines
+    rolls = [(payload, {k: v for k, v in response.items() if k != "secondary"}, pending) for payload, response, pending in rolls]
+
+    def write_log(future):
+        try: geo_info = future.result()
+        except Exception as e: app.logger.error(f"Geolocation failed: {e}", exc_info=True); ERRORS_TOTAL.inc(where="geo"); geo_info = {}
+        try:
+            entries = []
+            with stage("narrative"):
+                for payload, response, pending in rolls:
+                    log_entry = compose_narrative(payload, response, descriptor, geo_info, pending)
+                    entries.append({"timestamp": timestamp,"narrative": log_entry,"raw_payload": payload,"raw_response": response})
+                    print(f"NARRATIVE LOG: {log_entry}")
+            with stage("log_enqueue"): narrative_log.extend(entries)
+        except Exception as e: app.logger.error(f"Log write error: {e}", exc_info=True); ERRORS_TOTAL.inc(where="log_write"); print(f"CRITICAL: Log write fail: {e}")
+    geo_future.add_done_callback(write_log)
+
+
+def get_roll_result_and_log(payload, client_ip=None):
+    # Geolocation runs off the request thread; the narrative is written once it resolves
+    with stage("geo"): geo_future = geolocator.lookup_async(client_ip)
+    with stage("resolve"): response = resolve_roll_payload(payload)
+    if response["status"] == "success": log_rolls_when_located(geo_future, [(payload, response, None)], random.choice(RANDOM_DESCRIPTORS))
+    return response
+
+
+MAX_BATCH_ROLLS = 50
+
+def get_batch_result_and_log(specs, client_ip=None, auto_resolve_secondary=True):
+    """Resolve a list of roll specs with one geolocation lookup and one grouped log write.
+
+    All dice, including a d20 per spec for a possible injury/insanity chain, are drawn up front. Chained
+    secondary rolls are resolved in place and returned under each result's "secondary" key.
+    """
+    with stage("geo"): geo_future = geolocator.lookup_async(client_ip)
+    draws = [(random.randint(1, die_faces_for(spec)), random.randint(1, 20)) for spec in specs]
+    results, logged = [], []
+    for spec, (primary_roll, chain_roll) in zip(specs, draws):
+        with stage("resolve"): response = resolve_roll_payload(spec, primary_roll)
+        response["secondary"] = None
+        if response["status"] == "success":
+            logged.append((spec, response, None))
+            if auto_resolve_secondary and response.get("isSecondaryPrompt") and response.get("secondaryType") in SECONDARY_EFFECT_TABLES:
+                sec_payload = {"rollContext": "secondary", "rollType": response["secondaryType"],
+                               "primaryRollValue": response["rollValue"],
+                               "primaryResultText": response.get("resultText") or response.get("description")}
+                with stage("resolve"): secondary = resolve_roll_payload(sec_payload, chain_roll)
+                response["secondary"] = secondary
+                logged[-1] = (spec, response, False)
+                if secondary["status"] == "success": logged.append((sec_payload, secondary, None))
+        results.append(response)
+    if logged: log_rolls_when_located(geo_future, logged, random.choice(RANDOM_DESCRIPTORS))
+    return {"status": "success", "results": results}
+
+# --- Instrumentation ---
+# Every request gets a Server-Timing header built from its stages and feeds the /metrics histograms.
+# With PROFILE_TOKEN set, a request carrying a matching X-Profile-Token header is also sampled and its
+# folded stacks are written under LOG_STORAGE_DIR/profiles for flame-graph tools.
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+PROFILE_DIR = os.path.join(LOG_STORAGE_DIR, 'profiles')
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if PROFILE_TOKEN and request.headers.get('X-Profile-Token') == PROFILE_TOKEN:
+        g.profiler = SamplingProfiler(threading.get_ident()).start()
+
+@app.after_request
+def record_request_timing(response):
+    started = g.pop('request_started', None)
+    if started is None: return response
+    total = time.perf_counter() - started
+    REQUEST_SECONDS.observe(total, endpoint=request.endpoint or "unknown", status=str(response.status_code))
+    if response.status_code >= 500: ERRORS_TOTAL.inc(where=f"http_{request.endpoint or 'unknown'}")
+    header = server_timing_header(g.get('stage_timings', []), total)
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.stop()
         try:
-            log_data = {"timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),"narrative": log_entry,"raw_payload": payload,"raw_response": response}
-            with open(NARRATIVE_LOG_FILE_PATH, "a", encoding="utf-8") as lf: lf.write(json.dumps(log_data) + "\n")
-            print(f"NARRATIVE LOG: {log_entry}")
-        except Exception as e: app.logger.error(f"Log write error: {e}", exc_info=True); print(f"CRITICAL: Log write fail: {e}")
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            name = f"{datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%S%f')}-{request.endpoint}.folded"
+            with open(os.path.join(PROFILE_DIR, name), "w", encoding="utf-8") as pf: pf.write(profiler.folded())
+            header += f', profile;desc="{name} ({sum(profiler.samples.values())} samples)"'
+        except OSError as e: app.logger.error(f"Profile write error: {e}")
+    response.headers['Server-Timing'] = header
     return response
 
 # --- Routes ---
 @app.route('/', methods=['GET'])
 def index():
-    sv_tables = CRIT_DATA.get('Sterling Vermin', {})
-    dmg_types = sorted([k for k in sv_tables.keys() if not k.startswith('magic:')])
-    magic_subs = sorted([k for k in sv_tables.keys() if k.startswith('magic:')])
-    return render_template('index.html', damage_types=dmg_types, magic_subtypes=magic_subs, 
+    # The page only changes with the table data and static assets, so render it once per version
+    # and let browsers revalidate with If-None-Match.
+    key = (INDEX_ETAG, request.script_root)
+    html = _index_html_cache.get(key)
+    if html is None:
+        html = _index_html_cache[key] = render_template('index.html', damage_types=SV_DAMAGE_TYPES, magic_subtypes=SV_MAGIC_SUBTYPES, 
                            selected_damage_type="slashing", selected_roll_type="crit", 
                            selected_crit_source="Sterling Vermin", selected_fumble_type="Questionable Arcana", 
                            selected_attack_type="Weapon")
+    response = make_response(html)
+    response.set_etag(INDEX_ETAG)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 @app.route('/roll', methods=['POST'])
 def roll_ajax():
@@ -313,26 +424,103 @@ def roll_ajax():
     xff = request.headers.get('X-Forwarded-For'); ip = xff.split(',')[0].strip() if xff else request.remote_addr
     return jsonify(get_roll_result_and_log(p, ip))
 
+@app.route('/roll_batch', methods=['POST'])
+def roll_batch():
+    p = request.get_json(silent=True) or {}
+    specs = p.get('rolls')
+    if not isinstance(specs, list) or not specs or not all(isinstance(spec, dict) for spec in specs):
+        return jsonify({"status": "error", "errorMessage": "Expected a non-empty 'rolls' list of roll specs."}), 400
+    if len(specs) > MAX_BATCH_ROLLS: return jsonify({"status": "error", "errorMessage": f"At most {MAX_BATCH_ROLLS} rolls per batch."}), 400
+    auto_resolve = p.get('autoResolveSecondary', True)
+    if not isinstance(auto_resolve, bool): return jsonify({"status": "error", "errorMessage": "'autoResolveSecondary' must be true or false."}), 400
+    xff = request.headers.get('X-Forwarded-For'); ip = xff.split(',')[0].strip() if xff else request.remote_addr
+    return jsonify(get_batch_result_and_log(specs, ip, auto_resolve_secondary=auto_resolve))
+
+MAX_AUDIT_SIMULATIONS = 1_000_000
+
+@app.route('/audit', methods=['GET'])
+def audit():
+    source = request.args.get('source')
+    if source and source not in CRIT_TABLES and source not in FUMBLE_TABLES: return jsonify({"status": "error", "errorMessage": f"Unknown source: {source}"}), 400
+    try:
+        n = min(int(request.args.get('simulate', 0)), MAX_AUDIT_SIMULATIONS)
+        seed = int(request.args['seed']) if 'seed' in request.args else None
+    except ValueError: return jsonify({"status": "error", "errorMessage": "simulate and seed must be integers."}), 400
+    exact = exact_report(CRIT_TABLES, FUMBLE_TABLES, source)
+    simulated = None
+    if n > 0:
+        try: simulated = compare(exact, simulate(CRIT_TABLES, FUMBLE_TABLES, n, seed, source))
+        except RuntimeError as e: return jsonify({"status": "error", "errorMessage": str(e)}), 501
+    return jsonify({"status": "success", "exact": exact, "simulated": simulated})
+
 @app.route('/share_discord', methods=['POST'])
 def share_discord(): 
-    url = os.environ.get('DISCORD_WEBHOOK_URL')
-    if not url: return jsonify({"status": "error", "error": "Webhook URL not configured."}), 500
-    p = request.get_json(); msg = p.get('message')
+    if not discord_delivery.webhook_url: return jsonify({"status": "error", "error": "Webhook URL not configured."}), 500
+    p = request.get_json(silent=True) or {}; msg = p.get('message')
     if not msg: return jsonify({"status": "error", "error": "No message content."}), 400
-    try: requests.post(url, json={'content': msg}).raise_for_status(); return jsonify({"status": "success"})
-    except Exception as e: app.logger.error(f"Discord send error: {e}"); return jsonify({"status": "error", "error": str(e)}), 500
+    try:
+        with stage("discord_enqueue"): delivery_id = discord_delivery.submit(msg)
+    except queue.Full: ERRORS_TOTAL.inc(where="discord_queue_full"); return jsonify({"status": "error", "error": "Too many shares in flight, try again shortly."}), 503
+    return jsonify({"status": "queued", "deliveryId": delivery_id, "statusUrl": url_for('share_discord_status', delivery_id=delivery_id)}), 202
+
+@app.route('/share_discord/<delivery_id>', methods=['GET'])
+def share_discord_status(delivery_id):
+    status = discord_delivery.status(delivery_id)
+    if status is None: return jsonify({"status": "unknown", "error": "Unknown delivery id."}), 404
+    return jsonify(status)
     
 @app.route('/get_roll_history', methods=['GET'])
 def get_roll_history(): 
-    logs = []
-    if not os.path.exists(NARRATIVE_LOG_FILE_PATH): return jsonify([])
+    before = request.args.get('before')
+    try: limit = max(1, min(int(request.args.get('limit', 50)), 200))
+    except ValueError: return jsonify({"status":"error","msg":"limit must be an integer."}),400
     try:
-        with open(NARRATIVE_LOG_FILE_PATH, "r", encoding="utf-8") as lf: lines = lf.readlines()
-        for line in lines[-50:]:
-            try: entry = json.loads(line); logs.append({"ts": entry.get("timestamp"), "nar": entry.get("narrative")})
-            except: pass 
-        return jsonify(list(reversed([{"timestamp":l["ts"], "narrative":l["nar"]} for l in logs if l.get("nar")])))
-    except Exception as e: app.logger.error(f"History read error: {e}"); return jsonify({"status":"error","msg":"History fail."}),500
+        with stage("history_read"): records = read_history(NARRATIVE_LOG_FILE_PATH, narrative_log.segments(), before=before, limit=limit, recent=shared_state.recent)
+        return jsonify(records)
+    except InvalidCursor as e: return jsonify({"status":"error","msg":str(e)}),400
+    except Exception as e: app.logger.error(f"History read error: {e}"); ERRORS_TOTAL.inc(where="history"); return jsonify({"status":"error","msg":"History fail."}),500
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    try: top = max(1, min(int(request.args.get('top', 5)), 50))
+    except ValueError: return jsonify({"status": "error", "errorMessage": "top must be an integer."}), 400
+    with stage("stats_read"): snapshot = roll_stats.snapshot()
+    return jsonify({"status": "success", **summarize_stats(snapshot, top)})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+def sse_event(record):
+    return f"id: {record['id']}\nevent: roll\ndata: {json.dumps({'timestamp': record['timestamp'], 'narrative': record['narrative']})}\n\n"
+
+@app.route('/roll_stream', methods=['GET'])
+def roll_stream():
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('lastEventId')
+    if not live_feed.acquire_slot(STREAM_MAX_CLIENTS): return jsonify({"status":"error","msg":"Too many live viewers, falling back to polling."}),503
+    live_feed.start(); seq = live_feed.seq
+    try: replay = read_after(NARRATIVE_LOG_FILE_PATH, narrative_log.segments(), last_event_id) if last_event_id else []
+    except InvalidCursor: replay = []  # resume point rotated away; just start live
+    except Exception as e: live_feed.release_slot(); app.logger.error(f"Stream resume error: {e}"); return jsonify({"status":"error","msg":"Stream fail."}),500
+
+    def generate():
+        nonlocal seq
+        try:
+            yield "retry: 3000\n\n"
+            sent = set()
+            for record in replay: sent.add(record['id']); yield sse_event(record)
+            while not live_feed.closed:
+                records, seq = live_feed.wait(seq, STREAM_HEARTBEAT_SECONDS)
+                if live_feed.closed: return  # worker shutting down; the browser reconnects to another one
+                if not records: yield ": keepalive\n\n"; continue
+                for record in records:
+                    if record['id'] in sent: continue  # already replayed from the log
+                    yield sse_event(record)
+        finally: live_feed.release_slot()
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # keep reverse proxies from buffering the stream
+    return response
 
 if __name__ == '__main__':
     app.run()
\ No newline at end of file
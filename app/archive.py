@@ -0,0 +1,270 @@
+"""Compact columnar archives of rotated narrative log segments.
+
+    python -m app.archive [--log-dir DIR] [--keep-jsonl] [--rebuild-stats]
+
+Each rotated `<stem>.<stamp>.jsonl` segment becomes `<stem>.<stamp>.narc`. It keeps one typed column
+per fact, with source, table, damage type and result text interned into per-file dictionaries, plus the
+timestamp and narrative that history reads need. Rows remember the byte offset and the archive the
+inode and first-line tag of the segment they came from, so history cursors handed out before compaction
+keep working.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from collections import OrderedDict
+
+from app.stats import RollStats, empty_stats, merge_facts, roll_facts
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_EXT = ".narc"
+MAGIC = b"NARC"
+FORMAT_VERSION = 1
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_NO_TIMESTAMP = -(2 ** 63)
+
+# name -> array typecode; "dict" columns are uint16 codes into a per-file dictionary (0 = missing)
+COLUMNS = OrderedDict([
+    ("offset", "Q"), ("timestamp", "q"), ("rollValue", "H"),
+    ("context", "dict"), ("rollType", "dict"), ("source", "dict"), ("table", "dict"),
+    ("damageType", "dict"), ("secondaryType", "dict"), ("result", "dict"), ("narrative", "text"),
+])
+
+
+def is_archive(path):
+    return path.endswith(ARCHIVE_EXT)
+
+
+def archive_path_for(segment_path):
+    return os.path.splitext(segment_path)[0] + ARCHIVE_EXT
+
+
+def _to_micros(timestamp):
+    try: return (datetime.datetime.fromisoformat(timestamp) - _EPOCH) // datetime.timedelta(microseconds=1)
+    except (TypeError, ValueError): return _NO_TIMESTAMP
+
+
+def _from_micros(micros):
+    return None if micros == _NO_TIMESTAMP else (_EPOCH + datetime.timedelta(microseconds=micros)).isoformat()
+
+
+def _le(values):
+    if sys.byteorder == "big": values.byteswap()
+    return values
+
+
+# --- Writing ---
+def write_archive(segment_path, archive_path=None):
+    """Convert one JSONL segment into an archive next to it; returns the number of rows written."""
+    from app.history import line_tag  # app.history reads archives, so not at import time
+    archive_path = archive_path or archive_path_for(segment_path)
+    columns = {name: array("B" if kind == "text" else ("H" if kind == "dict" else kind)) for name, kind in COLUMNS.items()}
+    dictionaries = {name: {} for name, kind in COLUMNS.items() if kind == "dict"}
+    narratives, skipped, tag = [], 0, None
+    with open(segment_path, "rb") as f:
+        inode = os.fstat(f.fileno()).st_ino
+        offset = 0
+        for line in f:
+            pos, offset = offset, offset + len(line)
+            if pos == 0 and line.endswith(b"\n"): tag = line_tag(line)
+            if not line.endswith(b"\n") or not line.strip(): continue
+            try: entry = json.loads(line)
+            except ValueError: skipped += 1; continue
+            facts = roll_facts(entry)
+            columns["offset"].append(pos)
+            columns["timestamp"].append(_to_micros(entry.get("timestamp")))
+            columns["rollValue"].append(facts["rollValue"] if facts["rollValue"] and 0 < facts["rollValue"] < 65536 else 0)
+            for name, values in dictionaries.items():
+                value = facts[name]
+                if value is None: code = 0
+                else:
+                    code = values.get(value)
+                    if code is None:
+                        if len(values) >= 65535: raise ValueError(f"Too many distinct {name} values in {segment_path}")
+                        code = values[value] = len(values) + 1
+                columns[name].append(code)
+            narratives.append((entry.get("narrative") or "").encode("utf-8"))
+    if skipped: logger.warning(f"Skipped {skipped} unreadable line(s) in {segment_path}")
+
+    lengths = array("I", (len(n) for n in narratives))
+    blobs, specs = [], []
+    for name, kind in COLUMNS.items():
+        raw = (_le(lengths).tobytes() + b"".join(narratives)) if kind == "text" else _le(columns[name]).tobytes()
+        blob = zlib.compress(raw, 6)
+        spec = {"name": name, "type": kind, "length": len(blob)}
+        if kind == "dict": spec["values"] = list(dictionaries[name])
+        specs.append(spec); blobs.append(blob)
+    header = json.dumps({"version": FORMAT_VERSION, "rows": len(narratives), "sourceInode": inode,
+                         "sourceTag": tag, "sourceName": os.path.basename(segment_path), "columns": specs}).encode("utf-8")
+    tmp = f"{archive_path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC + struct.pack("<BI", FORMAT_VERSION, len(header)) + header)
+        for blob in blobs: f.write(blob)
+        f.flush(); os.fsync(f.fileno())
+    os.replace(tmp, archive_path)
+    return len(narratives)
+
+
+# --- Reading ---
+class Archive:
+    """A loaded archive; columns are decompressed on first use."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f: header = _read_header(f, path); data = f.read()
+        self.rows = header["rows"]
+        self.source_inode = header["sourceInode"]
+        self.source_tag = header.get("sourceTag")  # absent from archives written before tags existed
+        self.source_name = header["sourceName"]
+        self._specs, self._raw, self._decoded = {}, {}, {}
+        self._lock = threading.Lock()
+        pos = 0
+        for spec in header["columns"]:
+            self._specs[spec["name"]] = spec
+            self._raw[spec["name"]] = data[pos:pos + spec["length"]]; pos += spec["length"]
+
+    def column(self, name):
+        """Decoded values of one column: ints for numeric columns, strings (or None) for the rest."""
+        with self._lock:
+            if name not in self._decoded: self._decoded[name] = self._decode(self._specs[name])
+            return self._decoded[name]
+
+    def _decode(self, spec):
+        raw = zlib.decompress(self._raw[spec["name"]])
+        if spec["type"] == "text":
+            lengths = array("I"); lengths.frombytes(raw[:self.rows * lengths.itemsize]); _le(lengths)
+            texts, pos = [], self.rows * lengths.itemsize
+            for n in lengths: texts.append(raw[pos:pos + n].decode("utf-8")); pos += n
+            return texts
+        values = array("H" if spec["type"] == "dict" else spec["type"]); values.frombytes(raw); _le(values)
+        if spec["type"] != "dict": return values
+        lookup = [None] + spec["values"]
+        return [lookup[code] for code in values]
+
+    def records(self):
+        """Every row as a dict of facts plus offset, timestamp and narrative, oldest first."""
+        names = list(self._specs)
+        columns = [self.column(name) for name in names]
+        for row in zip(*columns):
+            record = dict(zip(names, row))
+            record["timestamp"] = _from_micros(record["timestamp"]); record["rollValue"] = record["rollValue"] or None
+            yield record
+
+    def iter_backward(self, end=None):
+        """Yield (offset, timestamp, narrative) for rows whose original offset is before `end`, newest first."""
+        offsets, timestamps, narratives = self.column("offset"), self.column("timestamp"), self.column("narrative")
+        for i in range(self.rows - 1, -1, -1):
+            if end is not None and offsets[i] >= end: continue
+            yield offsets[i], _from_micros(timestamps[i]), narratives[i]
+
+    def iter_forward(self, start=0, inclusive=True):
+        """Yield (offset, timestamp, narrative) for rows at (or after, if not inclusive) `start`, oldest first."""
+        offsets, timestamps, narratives = self.column("offset"), self.column("timestamp"), self.column("narrative")
+        for i in range(self.rows):
+            if offsets[i] < start or (not inclusive and offsets[i] == start): continue
+            yield offsets[i], _from_micros(timestamps[i]), narratives[i]
+
+
+def _read_header(f, path):
+    """Read and check the magic and JSON header, leaving f at the first column."""
+    prefix = f.read(4 + struct.calcsize("<BI"))
+    if prefix[:4] != MAGIC: raise ValueError(f"{path} is not a narrative archive")
+    version, header_len = struct.unpack_from("<BI", prefix, 4)
+    if version != FORMAT_VERSION: raise ValueError(f"{path} has unsupported archive version {version}")
+    return json.loads(f.read(header_len))
+
+
+_sources_seen = {}  # (path, mtime_ns) -> (source inode, source tag)
+SOURCE_CACHE_SIZE = 4096
+
+
+def archive_source(path):
+    """(inode, tag) of the segment an archive replaced, from its header alone; raises FileNotFoundError if it is gone."""
+    key = (path, os.stat(path).st_mtime_ns)
+    source = _sources_seen.get(key)
+    if source is None:
+        with open(path, "rb") as f: header = _read_header(f, path)
+        source = (header["sourceInode"], header.get("sourceTag"))
+        if len(_sources_seen) >= SOURCE_CACHE_SIZE: _sources_seen.clear()
+        _sources_seen[key] = source
+    return source
+
+
+_cache = OrderedDict()  # (path, mtime_ns) -> Archive
+_cache_lock = threading.Lock()
+CACHE_SIZE = 8
+
+
+def load_archive(path):
+    """Open an archive, reusing a recently loaded copy; raises FileNotFoundError if it is gone."""
+    key = (path, os.stat(path).st_mtime_ns)
+    with _cache_lock:
+        if key in _cache: _cache.move_to_end(key); return _cache[key]
+    archive = Archive(path)
+    with _cache_lock:
+        _cache[key] = archive
+        while len(_cache) > CACHE_SIZE: _cache.popitem(last=False)
+    return archive
+
+
+# --- Compaction job ---
+def compact_segments(segment_paths, keep_jsonl=False):
+    """Archive every JSONL segment that has no archive yet; returns [(segment, rows, jsonl bytes, archive bytes)]."""
+    done = []
+    for segment in segment_paths:
+        if is_archive(segment): continue
+        target = archive_path_for(segment)
+        if not os.path.exists(target):
+            rows = write_archive(segment, target)
+            done.append((segment, rows, os.path.getsize(segment), os.path.getsize(target)))
+        if not keep_jsonl: os.remove(segment)
+    return done
+
+
+def rebuild_stats(live_path, segment_paths):
+    """Recompute the /stats aggregates from archives and JSONL (a one-off, e.g. for logs older than the aggregates)."""
+    stats = empty_stats()
+    for path in list(segment_paths) + [live_path]:
+        if is_archive(path):
+            for record in load_archive(path).records(): merge_facts(stats, record["timestamp"], record)
+            continue
+        try:
+            with open(path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"): break
+                    try: entry = json.loads(line)
+                    except ValueError: continue
+                    merge_facts(stats, entry.get("timestamp"), roll_facts(entry))
+        except FileNotFoundError: continue
+    return stats
+
+
+def main(argv=None):
+    # Importing the app module just for its paths would start the whole service, so mirror its layout
+    parser = argparse.ArgumentParser(description="Compact rotated narrative log segments into columnar archives.")
+    parser.add_argument("--log-dir", default=os.environ.get("LOG_STORAGE_DIR", "."), help="directory holding the narrative log")
+    parser.add_argument("--keep-jsonl", action="store_true", help="keep the JSONL segments after archiving them")
+    parser.add_argument("--rebuild-stats", action="store_true", help="recompute the /stats aggregates from all history")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    from app.narrative_log import NarrativeLogWriter
+    writer = NarrativeLogWriter(os.path.join(args.log_dir, "narrative_dice_log.jsonl"))
+    for segment, rows, before, after in compact_segments(writer.segments(), args.keep_jsonl):
+        print(f"{os.path.basename(segment)}: {rows} rows, {before:,} -> {after:,} bytes ({before / max(after, 1):.1f}x)")
+    if args.rebuild_stats:
+        stats = rebuild_stats(writer.path, writer.segments())
+        RollStats(os.path.join(args.log_dir, "narrative_dice_log.stats.json")).replace(stats)
+        print(f"Rebuilt stats over {stats['rolls']} rolls.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import posixpath
+import re
+
+from flask import Response, abort, request, send_from_directory
+
+try:
+    import brotli
+except ImportError:  # optional; gzip alone still covers every browser
+    brotli = None
+
+COMPRESSIBLE_EXTENSIONS = {".css", ".svg", ".webmanifest", ".js", ".json", ".txt"}
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+CSS_URL_RE = re.compile(r"""url\((['"]?)([^'")]+)\1\)""")
+
+
+class AssetPipeline:
+    """Startup-built static asset pipeline.
+
+    Every file under the static folder is hashed and `url_for('static', ...)` gains a `?v=<hash>`
+    parameter. Relative `url()` references inside stylesheets are rewritten to their versioned URLs
+    before the stylesheet itself is hashed. Text assets are kept in memory along with gzip (and, when
+    the optional `brotli` package is installed, brotli) variants. A request whose `v` matches the
+    current hash is served with an immutable one-year Cache-Control.
+    """
+
+    def __init__(self, app=None):
+        self.versions = {}  # relpath -> content hash
+        self.bodies = {}  # relpath -> {"identity": bytes, "gzip": bytes, "br": bytes} for in-memory assets
+        if app is not None: self.init_app(app)
+
+    def init_app(self, app):
+        self.static_folder = app.static_folder
+        self.build()
+        app.url_defaults(self._add_version)
+        app.view_functions["static"] = self.serve
+
+    # --- Build ---
+    def build(self):
+        self.versions, self.bodies = {}, {}
+        files = []
+        for root, _dirs, names in os.walk(self.static_folder):
+            for name in names:
+                files.append(os.path.relpath(os.path.join(root, name), self.static_folder).replace(os.sep, "/"))
+        # Stylesheets go last so the assets they reference already have hashes to embed
+        for relpath in sorted(files, key=lambda p: (p.endswith(".css"), p)):
+            with open(os.path.join(self.static_folder, relpath), "rb") as f: data = f.read()
+            ext = os.path.splitext(relpath)[1].lower()
+            if ext == ".css": data = self._rewrite_css(relpath, data)
+            self.versions[relpath] = hashlib.sha256(data).hexdigest()[:12]
+            if ext in COMPRESSIBLE_EXTENSIONS:
+                variants = {"identity": data, "gzip": gzip.compress(data, compresslevel=9, mtime=0)}
+                if brotli is not None: variants["br"] = brotli.compress(data)
+                self.bodies[relpath] = variants
+
+    def _rewrite_css(self, relpath, data):
+        base = posixpath.dirname(relpath)
+
+        def versioned(match):
+            quote, target = match.group(1), match.group(2)
+            if target.startswith(("data:", "http:", "https:", "/", "#")) or "?" in target: return match.group(0)
+            resolved = posixpath.normpath(posixpath.join(base, target))
+            version = self.versions.get(resolved)
+            return f"url({quote}{target}?v={version}{quote})" if version else match.group(0)
+        return CSS_URL_RE.sub(versioned, data.decode("utf-8")).encode("utf-8")
+
+    @property
+    def version(self):
+        """One hash over every asset, for anything (like the rendered index) that embeds asset URLs."""
+        return hashlib.sha256("".join(f"{p}:{v};" for p, v in sorted(self.versions.items())).encode()).hexdigest()[:12]
+
+    # --- Serving ---
+    def _add_version(self, endpoint, values):
+        if endpoint == "static" and "v" not in values:
+            version = self.versions.get(values.get("filename"))
+            if version: values["v"] = version
+
+    def serve(self, filename):
+        version = self.versions.get(filename)
+        if version is None: abort(404)
+        variants = self.bodies.get(filename)
+        if variants is None: response = send_from_directory(self.static_folder, filename)
+        else:
+            accepted = request.accept_encodings
+            encoding = next((e for e in ("br", "gzip") if e in variants and accepted[e]), "identity")
+            mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+            if filename.endswith(".webmanifest"): mimetype = "application/manifest+json"
+            response = Response(variants[encoding], mimetype=mimetype)
+            if encoding != "identity": response.headers["Content-Encoding"] = encoding
+            response.vary.add("Accept-Encoding")
+            response.set_etag(f"{version}-{encoding}")
+            response.make_conditional(request)
+        if request.args.get("v") == version: response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        else: response.headers["Cache-Control"] = "no-cache"
+        return response
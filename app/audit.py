@@ -0,0 +1,168 @@
+"""Exact and simulated outcome distributions for the crit and fumble tables.
+
+Run `python -m app.audit` from the repository root for a text report, `--json` for machine-readable
+output, and `--simulate N` to check the exact figures against N NumPy-vectorised primary+secondary
+chains (NumPy is only needed for simulation).
+"""
+import argparse
+import json
+import os
+import sys
+from fractions import Fraction
+
+from app.tables import SECONDARY_EFFECT_TABLES, compile_crit_data, compile_fumble_data, secondary_type_for
+
+DATA_DIR = os.path.dirname(__file__)
+SECONDARY_TYPES = list(SECONDARY_EFFECT_TABLES)
+
+
+def load_compiled_tables(data_dir=DATA_DIR):
+    with open(os.path.join(data_dir, "critical_hits_master.json")) as f: crit_data = json.load(f)
+    with open(os.path.join(data_dir, "fumbles_master.json")) as f: fumble_data = json.load(f)
+    return compile_crit_data(crit_data), compile_fumble_data(fumble_data)
+
+
+def outcome_label(value, width=60):
+    """Short human label for a table value: a fumble's description or a crit text's first sentence."""
+    text = value.get('description', '') if isinstance(value, dict) else str(value)
+    for stop in ("!", ". ", " Effect: ", ": "):
+        if stop in text: text = text.split(stop, 1)[0] + (stop.strip() if stop == "!" else ""); break
+    return text if len(text) <= width else text[:width - 1] + "…"
+
+
+def _primary_tables(crit_tables, fumble_tables, source=None):
+    """Yield (kind, source, key, table) for every table a primary roll can land on."""
+    for kind, compiled in (("crit", crit_tables), ("fumble", fumble_tables)):
+        for src, tables in compiled.items():
+            if src == "effects_tables" or (source and src != source): continue
+            for key, table in tables.items(): yield kind, src, key, table
+
+
+# --- Exact distributions ---
+def exact_distribution(table, kind, effects):
+    """Exact per-outcome probabilities, secondary-prompt rates and chained secondary outcome probabilities."""
+    counts = [0] * len(table.ranges); gap_faces = 0
+    prompt = {t: Fraction(0) for t in SECONDARY_TYPES}
+    for face in range(1, table.faces + 1):
+        idx = table.index[face]
+        if idx < 0: gap_faces += 1; continue
+        counts[idx] += 1
+        sec = secondary_type_for(table.ranges[idx][1]) if kind == "crit" else None
+        if sec: prompt[sec] += Fraction(1, table.faces)
+    chains = {}
+    for sec, p_sec in prompt.items():
+        eff = effects.get(SECONDARY_EFFECT_TABLES[sec])
+        if not p_sec or eff is None: continue
+        eff_counts = [0] * len(eff.ranges)
+        for face in range(1, eff.faces + 1):
+            if eff.index[face] >= 0: eff_counts[eff.index[face]] += 1
+        chains[sec] = [{"roll": r, "label": outcome_label(v), "probability": float(p_sec * Fraction(c, eff.faces))}
+                       for (r, v), c in zip(eff.ranges, eff_counts)]
+    return {
+        "die": f"d{table.faces}",
+        "outcomes": [{"roll": r, "label": outcome_label(v), "probability": float(Fraction(c, table.faces))}
+                     for (r, v), c in zip(table.ranges, counts)],
+        "noResultProbability": float(Fraction(gap_faces, table.faces)),
+        "secondaryPromptRates": {t: float(p) for t, p in prompt.items()},
+        "anySecondaryRate": float(sum(prompt.values())),
+        "chainedOutcomes": chains,
+    }
+
+
+def exact_report(crit_tables, fumble_tables, source=None):
+    effects = crit_tables.get("effects_tables", {})
+    return [dict(kind=kind, source=src, table=key, **exact_distribution(table, kind, effects))
+            for kind, src, key, table in _primary_tables(crit_tables, fumble_tables, source)]
+
+
+# --- Monte Carlo ---
+def simulate(crit_tables, fumble_tables, n=1_000_000, seed=None, source=None):
+    """Roll n primary+secondary chains per table with NumPy and report observed frequencies."""
+    try:
+        import numpy as np
+    except ImportError:
+        raise RuntimeError("Simulation needs NumPy: pip install numpy")
+    rng = np.random.default_rng(seed)
+    effects = crit_tables.get("effects_tables", {})
+    sec_codes = {t: i + 1 for i, t in enumerate(SECONDARY_TYPES)}
+    report = []
+    for kind, src, key, table in _primary_tables(crit_tables, fumble_tables, source):
+        face_outcome = np.array(table.index, dtype=np.int64)
+        face_secondary = np.zeros(table.faces + 1, dtype=np.int64)
+        if kind == "crit":
+            for face in range(1, table.faces + 1):
+                idx = table.index[face]
+                if idx >= 0: face_secondary[face] = sec_codes.get(secondary_type_for(table.ranges[idx][1]), 0)
+        faces = rng.integers(1, table.faces + 1, size=n)
+        outcomes = face_outcome[faces]
+        counts = np.bincount(outcomes[outcomes >= 0], minlength=len(table.ranges))
+        secondaries = face_secondary[faces]
+        chains, rates = {}, {}
+        for sec, code in sec_codes.items():
+            hits = int(np.count_nonzero(secondaries == code)); rates[sec] = hits / n
+            eff = effects.get(SECONDARY_EFFECT_TABLES[sec])
+            if not hits or eff is None: continue
+            eff_outcomes = np.array(eff.index, dtype=np.int64)[rng.integers(1, eff.faces + 1, size=hits)]
+            eff_counts = np.bincount(eff_outcomes[eff_outcomes >= 0], minlength=len(eff.ranges))
+            chains[sec] = [{"roll": r, "label": outcome_label(v), "frequency": int(c) / n} for (r, v), c in zip(eff.ranges, eff_counts)]
+        report.append({
+            "kind": kind, "source": src, "table": key, "die": f"d{table.faces}", "rolls": n,
+            "outcomes": [{"roll": r, "label": outcome_label(v), "frequency": int(c) / n} for (r, v), c in zip(table.ranges, counts)],
+            "noResultFrequency": int(np.count_nonzero(outcomes < 0)) / n,
+            "secondaryPromptRates": rates,
+            "anySecondaryRate": sum(rates.values()),
+            "chainedOutcomes": chains,
+        })
+    return report
+
+
+def compare(exact, simulated):
+    """Attach each simulated table's largest absolute deviation from the exact outcome probabilities."""
+    exact_by_table = {(t["kind"], t["source"], t["table"]): t for t in exact}
+    for sim in simulated:
+        ex = exact_by_table[(sim["kind"], sim["source"], sim["table"])]
+        sim["maxDeviation"] = max((abs(a["probability"] - b["frequency"]) for a, b in zip(ex["outcomes"], sim["outcomes"])), default=0.0)
+    return simulated
+
+
+# --- CLI ---
+def _format_text(exact, simulated=None):
+    sim_by_table = {(t["kind"], t["source"], t["table"]): t for t in simulated or []}
+    lines = []
+    for t in exact:
+        sim = sim_by_table.get((t["kind"], t["source"], t["table"]))
+        lines.append(f"{t['source']} {t['kind']} / {t['table']} ({t['die']})")
+        for i, o in enumerate(t["outcomes"]):
+            observed = f"  sim {sim['outcomes'][i]['frequency']:7.3%}" if sim else ""
+            lines.append(f"  {o['roll']:>7}  {o['probability']:7.3%}{observed}  {o['label']}")
+        if t["noResultProbability"]: lines.append(f"  no result  {t['noResultProbability']:7.3%}")
+        if t["anySecondaryRate"]:
+            rates = ", ".join(f"{k} {v:.1%}" for k, v in t["secondaryPromptRates"].items() if v)
+            observed = ", ".join(f"{k} {v:.1%}" for k, v in sim["secondaryPromptRates"].items() if v) if sim else ""
+            lines.append(f"  secondary prompts: {rates}" + (f"  (sim: {observed})" if sim else ""))
+        if sim: lines.append(f"  max deviation over {sim['rolls']:,} rolls: {sim['maxDeviation']:.4%}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.audit", description=__doc__.splitlines()[0])
+    parser.add_argument("--source", help="only audit this source (e.g. 'Sterling Vermin')")
+    parser.add_argument("--simulate", type=int, metavar="N", help="also simulate N chains per table (needs NumPy)")
+    parser.add_argument("--seed", type=int, help="seed for reproducible simulations")
+    parser.add_argument("--json", action="store_true", help="print JSON instead of a text report")
+    args = parser.parse_args(argv)
+
+    crit_tables, fumble_tables = load_compiled_tables()
+    exact = exact_report(crit_tables, fumble_tables, args.source)
+    simulated = None
+    if args.simulate:
+        try: simulated = compare(exact, simulate(crit_tables, fumble_tables, args.simulate, args.seed, args.source))
+        except RuntimeError as e: print(e, file=sys.stderr); return 1
+    if args.json: print(json.dumps({"exact": exact, "simulated": simulated}, indent=2))
+    else: print(_format_text(exact, simulated))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,191 @@
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.metrics import ERRORS_TOTAL, stage
+
+logger = logging.getLogger(__name__)
+
+DISCORD_CONTENT_LIMIT = 2000
+_STOP = object()
+
+
+def pack_messages(messages, limit=DISCORD_CONTENT_LIMIT, separator="\n\n"):
+    """Group (delivery_id, text) pairs into posts of at most `limit` characters.
+
+    Returns a list of (content, delivery_ids). A message longer than the limit is split across
+    consecutive posts, preferring to break at a newline.
+    """
+    posts, parts, ids, size = [], [], [], 0
+    for delivery_id, text in messages:
+        for chunk in _split(text, limit):
+            extra = len(chunk) + (len(separator) if parts else 0)
+            if parts and size + extra > limit:
+                posts.append((separator.join(parts), ids)); parts, ids, size = [], [], 0
+                extra = len(chunk)
+            parts.append(chunk); size += extra
+            if delivery_id not in ids: ids.append(delivery_id)
+    if parts: posts.append((separator.join(parts), ids))
+    return posts
+
+
+def _split(text, limit):
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0: cut = limit
+        yield text[:cut]
+        text = text[cut:].lstrip("\n")
+    if text: yield text
+
+
+class DiscordDelivery:
+    """Background, rate-limit-aware delivery of messages to a Discord webhook.
+
+    `submit` queues a message and returns a delivery id right away. A sender thread waits
+    `coalesce_window` seconds for more messages, packs them into as few posts as the 2000-character
+    limit allows and sends them over a pooled session. A 429 is retried after the Retry-After delay
+    Discord asks for, while 5xx and network errors back off exponentially. `status` reports
+    queued / sending / sent / failed for each delivery id.
+
+    With `shared` (a shared_state.SharedDeliveryStatuses), statuses are also kept where every gunicorn
+    worker can see them, so a status poll that lands on another worker still gets an answer.
+    """
+
+    def __init__(self, webhook_url, coalesce_window=1.0, max_queue=100, timeout=10, max_attempts=5,
+                 max_backoff=30, max_statuses=1000, shared=None):
+        self.webhook_url = webhook_url
+        self.shared = shared
+        self.coalesce_window = coalesce_window
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.max_backoff = max_backoff
+        self.max_statuses = max_statuses
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._statuses = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._session = None
+
+    # --- Public API ---
+    def submit(self, message):
+        """Queue a message; returns its delivery id, or raises queue.Full if the backlog is full."""
+        self._ensure_started()
+        delivery_id = uuid.uuid4().hex
+        self._set_status(delivery_id, "queued")
+        try: self._queue.put_nowait((delivery_id, message))
+        except queue.Full: self._set_status(delivery_id, "failed", "Delivery queue is full."); raise
+        return delivery_id
+
+    def status(self, delivery_id):
+        with self._lock:
+            item = self._statuses.get(delivery_id)
+            if item: return dict(item)
+        return self.shared.get(delivery_id) if self.shared is not None else None
+
+    def close(self, timeout=5):
+        if self._thread is None or self._pid != os.getpid(): return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _set_status(self, delivery_id, status, error=None):
+        if self.shared is not None: self.shared.set(delivery_id, status, error)
+        with self._lock:
+            self._statuses[delivery_id] = {"status": status, "error": error}
+            self._statuses.move_to_end(delivery_id)
+            while len(self._statuses) > self.max_statuses: self._statuses.popitem(last=False)
+
+    # --- Sender thread ---
+    # Started lazily (and again after fork) so each gunicorn worker owns its thread and session.
+    def _ensure_started(self):
+        if self._thread is not None and self._pid == os.getpid(): return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid(): return
+            if self._pid != os.getpid(): self._queue = queue.Queue(maxsize=self._queue.maxsize); self._session = None
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="discord-delivery", daemon=True)
+            self._thread.start()
+
+    def _get_session(self):
+        if self._session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+            session.mount("http://", adapter); session.mount("https://", adapter)
+            self._session = session
+        return self._session
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP: return
+            pending, stop = [item], False
+            deadline = time.monotonic() + self.coalesce_window
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: break
+                try: item = self._queue.get(timeout=remaining)
+                except queue.Empty: break
+                if item is _STOP: stop = True; break
+                pending.append(item)
+            try: self._send(pending)
+            except Exception as e:
+                # Keep the thread alive: a dead sender would leave every later share queued for good
+                ERRORS_TOTAL.inc(where="discord"); logger.error(f"Discord delivery of {len(pending)} message(s) failed: {e}", exc_info=True)
+                for delivery_id, _message in pending:
+                    if (self.status(delivery_id) or {}).get("status") != "sent": self._set_status(delivery_id, "failed", "Internal error while sending.")
+            if stop: return
+
+    def _send(self, pending):
+        for content, ids in pack_messages(pending):
+            for delivery_id in ids: self._set_status(delivery_id, "sending")
+            with stage("discord_post"): error = self._post(content)
+            if error: ERRORS_TOTAL.inc(where="discord")
+            for delivery_id in ids:
+                # A message split over several posts fails if any part fails
+                if error: self._set_status(delivery_id, "failed", error)
+                elif (self.status(delivery_id) or {}).get("status") != "failed": self._set_status(delivery_id, "sent")
+
+    def _post(self, content):
+        """Send one post, retrying per Discord's rate limits; returns None on success or an error string."""
+        error = "Not attempted."
+        for attempt in itertools.count(1):
+            try:
+                response = self._get_session().post(self.webhook_url, json={"content": content}, timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                error = f"Discord unreachable: {type(e).__name__}"; delay = self._backoff(attempt)
+            else:
+                if response.ok: return None
+                if response.status_code == 429:
+                    error = "Rate limited by Discord."; delay = self._retry_after(response, attempt)
+                elif response.status_code >= 500:
+                    error = f"Discord error {response.status_code}."; delay = self._backoff(attempt)
+                else:
+                    logger.error(f"Discord rejected webhook post: {response.status_code} {response.text[:200]}")
+                    return f"Discord rejected the message ({response.status_code})."
+            if attempt >= self.max_attempts: break
+            logger.warning(f"Discord send attempt {attempt} failed ({error}); retrying in {delay:.2f}s")
+            time.sleep(delay)
+        logger.error(f"Discord send error after {self.max_attempts} attempts: {error}")
+        return error
+
+    def _backoff(self, attempt):
+        return min(self.max_backoff, 0.5 * 2 ** (attempt - 1))
+
+    def _clamp(self, delay):
+        return min(self.max_backoff, max(0.0, delay))  # also maps NaN to 0; time.sleep rejects negatives
+
+    def _retry_after(self, response, attempt):
+        # Discord sends Retry-After in seconds and retry_after (seconds, possibly fractional) in the JSON body
+        try: return self._clamp(float(response.json().get("retry_after")))
+        except (ValueError, TypeError, AttributeError): pass
+        try: return self._clamp(float(response.headers.get("Retry-After")))
+        except (TypeError, ValueError): return self._backoff(attempt)
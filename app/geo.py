@@ -0,0 +1,182 @@
+import ipaddress
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.metrics import ERRORS_TOTAL, stage
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_GEO_API_URL = "http://ip-api.com/json/{ip}?fields=status,message,city,regionName,query"
+
+# Use a placeholder for IP addresses in log messages to avoid logging the actual IP.
+IP_DISPLAY_FOR_LOGS = "[IP REDACTED]"
+
+UNKNOWN_GEO = {"city": "parts unknown", "regionName": "mysterious land"}
+
+
+def classify_local(ip_address):
+    """Resolve addresses that never need the API (missing, loopback, private, Tailnet, malformed); None otherwise."""
+    if not ip_address: return {"city": "an unknown void", "regionName": "the ether"}
+    try:
+        ip_obj = ipaddress.ip_address(ip_address)
+        if ip_obj.is_loopback: return {"city": "their cozy terminal", "regionName": "the local machine"}
+        if ip_obj.is_private: return {"city": "their local sanctum", "regionName": "the home network"}
+        if ip_obj in ipaddress.ip_network('100.64.0.0/10', strict=False): return {"city": "their secure Tailnet", "regionName": "a private dimension"}
+    except ValueError:
+        # Handle cases like "localhost" string which is not a valid IP for ipaddress module
+        if isinstance(ip_address, str) and ip_address.lower() == "localhost":
+            return {"city": "their cozy terminal", "regionName": "the local machine"}
+        logger.warning(f"Invalid IP format for geolocation: {IP_DISPLAY_FOR_LOGS}")
+        return {"city": "an unidentifiable nexus", "regionName": "a glitch in the matrix"}
+    return None
+
+
+class GeoLocator:
+    """Cached ip-api.com client.
+
+    Results live in a bounded LRU keyed by IP; successes expire after `ttl` seconds and failures after
+    `negative_ttl`, so a flaky API is not hammered by repeat players. `lookup_async` runs misses on a
+    small worker pool and collapses concurrent lookups for the same IP into one request. At most
+    `max_pending` lookups wait on the pool; beyond that a new IP resolves at once to the "parts unknown"
+    fallback (negatively cached), so a slow or rate-limiting API cannot build up an unbounded backlog.
+
+    With `shared` (a shared_state.SharedGeoCache), results are also kept where every gunicorn worker
+    can see them; the per-process LRU stays in front of it as a lock-free first level.
+    """
+
+    def __init__(self, api_url=DEFAULT_GEO_API_URL, max_entries=1024, ttl=3600, negative_ttl=300, timeout=3, workers=2, max_pending=64, shared=None):
+        self.api_url = api_url
+        self.shared = shared
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.timeout = timeout
+        self.workers = workers
+        self.max_pending = max_pending
+        self._cache = OrderedDict()  # ip -> (expires_at, geo_info)
+        self._pending = {}  # ip -> Future for lookups already in flight
+        self._lock = threading.Lock()
+        self._session = None
+        self._executor = None
+
+    # The session and pool are created lazily so each gunicorn worker builds its own after fork.
+    def _get_session(self):
+        if self._session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+            session.mount("http://", adapter); session.mount("https://", adapter)
+            self._session = session
+        return self._session
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None: self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="geo")
+            return self._executor
+
+    # --- Cache ---
+    def cached(self, ip_address):
+        with self._lock:
+            item = self._cache.get(ip_address)
+            if item is not None and item[0] <= time.monotonic(): del self._cache[ip_address]; item = None
+            if item is not None: self._cache.move_to_end(ip_address); return item[1]
+        if self.shared is None: return None
+        hit = self.shared.get(ip_address)
+        if hit is None: return None
+        self._store(ip_address, hit[1], hit[0], local_only=True)
+        return hit[1]
+
+    def _store(self, ip_address, geo_info, ttl, local_only=False):
+        if self.shared is not None and not local_only: self.shared.put(ip_address, geo_info, ttl)
+        with self._lock:
+            self._cache[ip_address] = (time.monotonic() + ttl, geo_info)
+            self._cache.move_to_end(ip_address)
+            while len(self._cache) > self.max_entries: self._cache.popitem(last=False)
+
+    def clear(self):
+        with self._lock: self._cache.clear()
+
+    # --- Lookups ---
+    def lookup(self, ip_address):
+        """Blocking lookup: local classification, then cache, then the API."""
+        local = classify_local(ip_address)
+        if local is not None: return local
+        hit = self.cached(ip_address)
+        if hit is not None: return hit
+        with stage("geo_lookup"): geo_info, ok = self._fetch(ip_address)
+        if not ok: ERRORS_TOTAL.inc(where="geo_lookup")
+        self._store(ip_address, geo_info, self.ttl if ok else self.negative_ttl)
+        return geo_info
+
+    def lookup_async(self, ip_address):
+        """Return a Future for the geolocation; already resolved when no network call is needed."""
+        local = classify_local(ip_address)
+        if local is None: local = self.cached(ip_address)
+        if local is not None:
+            done = Future(); done.set_result(local)
+            return done
+        executor = self._get_executor()
+        with self._lock:
+            future = self._pending.get(ip_address)
+            if future is None and len(self._pending) < self.max_pending:
+                future = executor.submit(self.lookup, ip_address)
+                self._pending[ip_address] = future
+                future.add_done_callback(lambda _f: self._forget(ip_address))
+        if future is None: return self._overloaded(ip_address)
+        return future
+
+    def _overloaded(self, ip_address):
+        # Cached in this worker only: the backlog is this worker's, and other workers may still reach the API
+        ERRORS_TOTAL.inc(where="geo_overloaded")
+        logger.debug(f"Geo lookup backlog full ({self.max_pending}); skipping lookup for {IP_DISPLAY_FOR_LOGS}")
+        self._store(ip_address, dict(UNKNOWN_GEO), self.negative_ttl, local_only=True)
+        done = Future(); done.set_result(dict(UNKNOWN_GEO))
+        return done
+
+    def _forget(self, ip_address):
+        with self._lock: self._pending.pop(ip_address, None)
+
+    def _fetch(self, ip_address):
+        """Query the API; returns (geo_info, ok) where ok=False results are negatively cached."""
+        try:
+            response_geo = self._get_session().get(self.api_url.format(ip=ip_address), timeout=self.timeout)
+            response_geo.raise_for_status()
+            data = response_geo.json()
+
+            api_message = data.get('message', 'Unknown ip-api.com error')
+            # Sanitize api_message if it might contain the IP (ip-api.com puts the IP in the 'query' field of its response)
+            # and sometimes in the 'message' field for errors.
+            if data.get("query") and isinstance(api_message, str) and data.get("query") in api_message:
+                api_message = api_message.replace(data.get("query"), IP_DISPLAY_FOR_LOGS)
+
+            if data.get("status") == "success":
+                return {"city": data.get("city", "unknown city"), "regionName": data.get("regionName", "uncharted territory")}, True
+
+            logger.warning(f"Geo API error for {IP_DISPLAY_FOR_LOGS}: {api_message}")
+            return dict(UNKNOWN_GEO), False
+
+        except requests.exceptions.Timeout:
+            logger.warning(f"Geo request timed out for {IP_DISPLAY_FOR_LOGS}")
+            return {"city": "realm beyond reach", "regionName": "mists of time"}, False
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Error fetching geo for {IP_DISPLAY_FOR_LOGS}: {_redact(e, ip_address)}")
+            return {"city": "digital realm", "regionName": "boundless interwebs"}, False
+        except json.JSONDecodeError:
+            logger.warning(f"Failed to decode geo JSON for {IP_DISPLAY_FOR_LOGS}")
+            return {"city": "garbled signal", "regionName": "static void"}, False
+        except Exception as e:
+            # exc_info=True will log the stack trace; the exception message itself is sanitized.
+            logger.error(f"Generic geo error for {IP_DISPLAY_FOR_LOGS}: {_redact(e, ip_address)}", exc_info=True)
+            return {"city": "place beyond perception", "regionName": "the void"}, False
+
+
+def _redact(error, ip_address):
+    message = str(error)
+    if isinstance(ip_address, str) and ip_address in message: message = message.replace(ip_address, IP_DISPLAY_FOR_LOGS)
+    return message
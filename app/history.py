@@ -0,0 +1,197 @@
+import json
+import os
+import zlib
+from json.decoder import scanstring
+
+from app.archive import archive_source, is_archive, load_archive
+
+BLOCK_SIZE = 64 * 1024
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+# --- Cursors ---
+# A cursor names a record by (inode, tag, byte offset of its line). Inodes survive the rename done by log
+# rotation, so a cursor handed out for the live file still points at the same record once it has
+# become a rotated segment. Inodes are reused once a file is deleted (as compaction does), so the tag,
+# a checksum of the file's first line, tells a file apart from a later one that got the same inode.
+# Cursors from before tags existed ("inode-offset") parse with a tag of None.
+def make_cursor(inode, tag, offset):
+    return f"{inode:x}-{offset:x}" if tag is None else f"{inode:x}.{tag:x}-{offset:x}"
+
+
+def parse_cursor(cursor):
+    try:
+        ident, offset = cursor.split('-', 1)
+        inode, _, tag = ident.partition('.')
+        return int(inode, 16), int(tag, 16) if tag else None, int(offset, 16)
+    except (AttributeError, ValueError):
+        raise InvalidCursor(f"Malformed cursor: {cursor!r}")
+
+
+def line_tag(line):
+    return zlib.crc32(line)
+
+
+def first_line_tag(f):
+    """The tag of binary file f (see above), or None while its first line is incomplete; keeps f's position."""
+    pos = f.tell(); f.seek(0)
+    try: line = f.readline()
+    finally: f.seek(pos)
+    return line_tag(line) if line.endswith(b"\n") else None
+
+
+# --- Reading ---
+def iter_lines_backward(f, end, block_size=BLOCK_SIZE):
+    """Yield (offset, line) for complete lines in f ending at or before `end`, newest first.
+
+    Whatever follows the last newline before `end` is treated as a record still being written and skipped.
+    """
+    pos, tail, skipping = end, b"", True
+    while pos > 0:
+        size = min(block_size, pos); pos -= size
+        f.seek(pos)
+        lines = (f.read(size) + tail).split(b"\n")
+        if skipping:
+            if len(lines) == 1: tail = b""; continue  # still inside the unfinished record
+            lines.pop(); skipping = False
+        tail = lines[0]
+        offset = pos + len(tail) + 1
+        found = []
+        for line in lines[1:]:
+            found.append((offset, line)); offset += len(line) + 1
+        for item in reversed(found):
+            if item[1]: yield item
+    if tail and not skipping: yield 0, tail
+
+
+def summarize_line(line):
+    """Pull timestamp and narrative out of a log line without decoding raw_payload/raw_response.
+
+    Lines written by NarrativeLogWriter start with those two keys; anything else falls back to json.loads.
+    """
+    text = line.decode("utf-8", errors="replace")
+    prefix_ts, prefix_nar = '{"timestamp": "', '", "narrative": "'
+    if text.startswith(prefix_ts):
+        try:
+            timestamp, end = scanstring(text, len(prefix_ts))
+            if text.startswith(prefix_nar[1:], end):
+                narrative, _ = scanstring(text, end + len(prefix_nar) - 1)
+                return timestamp, narrative
+        except ValueError: pass
+    try: entry = json.loads(text)
+    except ValueError: return None, None
+    return entry.get("timestamp"), entry.get("narrative")
+
+
+_tags = {}  # (path, inode, ctime) -> tag; a segment's first line never changes, so it is read once
+TAG_CACHE_SIZE = 4096
+
+
+def _file_tag(path, st):
+    key = (path, st.st_ino, st.st_ctime_ns)
+    tag = _tags.get(key)
+    if tag is None:
+        with open(path, "rb") as f: tag = first_line_tag(f)
+        if tag is not None:
+            if len(_tags) >= TAG_CACHE_SIZE: _tags.clear()
+            _tags[key] = tag
+    return tag
+
+
+def _sources(paths):
+    """[(path, (inode, tag), size)] for the paths that exist; archives (size None) report the segment they replaced.
+
+    Only archive headers are read here; an archive's columns are loaded when a walk reaches it.
+    """
+    sources = []
+    for path in paths:
+        try:
+            if is_archive(path): sources.append((path, archive_source(path), None))
+            else: st = os.stat(path); sources.append((path, (st.st_ino, _file_tag(path, st)), st.st_size))
+        except FileNotFoundError: continue
+    return sources
+
+
+def _find(sources, cursor):
+    inode, tag, offset = parse_cursor(cursor)
+    for i, source in enumerate(sources):
+        if source[1] == (inode, tag) or (tag is None and source[1][0] == inode): return i, offset
+    raise InvalidCursor(f"Cursor {cursor!r} refers to a log file that no longer exists")
+
+
+def read_history(live_path, segment_paths, before=None, limit=50, recent=None):
+    """Return up to `limit` records ({"id", "timestamp", "narrative"}), newest first, older than `before`.
+
+    Only the blocks holding the requested records are read, so the cost does not grow with the log size.
+    With `recent` (a shared_state.RecentRolls), records still in the shared ring come from memory and the
+    files are only read for whatever is older.
+    """
+    if recent is not None:
+        records = recent.read(before, limit)
+        if records is not None:
+            if len(records) >= limit: return records
+            return records + read_history(live_path, segment_paths, records[-1]["id"] if records else before, limit - len(records))
+    sources = _sources([live_path] + list(reversed(segment_paths)))  # newest first
+    start, end_offset = _find(sources, before) if before else (0, None)
+
+    records = []
+    for path, (inode, tag), size in sources[start:]:
+        if size is None:
+            try: rows = load_archive(path).iter_backward(end_offset)
+            except FileNotFoundError: end_offset = None; continue
+        else:
+            try: f = open(path, "rb")
+            except FileNotFoundError: end_offset = None; continue
+            rows = _summarized(iter_lines_backward(f, size if end_offset is None else min(end_offset, size)), f)
+        end_offset = None
+        for offset, timestamp, narrative in rows:
+            if not narrative: continue
+            records.append({"id": make_cursor(inode, tag, offset), "timestamp": timestamp, "narrative": narrative})
+            if len(records) >= limit: rows.close(); return records
+    return records
+
+
+def read_after(live_path, segment_paths, after, limit=200):
+    """Return up to `limit` records written after the record `after` names, oldest first.
+
+    Used to resume a live feed from a Last-Event-ID; reading starts at the cursor's offset, so the cost
+    depends on how far behind the client is, not on the size of the log.
+    """
+    sources = _sources(list(segment_paths) + [live_path])  # oldest first
+    i, offset = _find(sources, after)
+
+    records, first = [], True
+    for path, (inode, tag), size in sources[i:]:
+        if size is None:
+            try: rows = load_archive(path).iter_forward(offset, inclusive=not first)
+            except FileNotFoundError: offset, first = 0, False; continue
+        else:
+            try: f = open(path, "rb")
+            except FileNotFoundError: offset, first = 0, False; continue
+            f.seek(offset)
+            if first: f.readline()  # the record the cursor names has already been seen
+            rows = _summarized(iter_lines_forward(f), f)
+        offset, first = 0, False
+        for pos, timestamp, narrative in rows:
+            if not narrative: continue
+            records.append({"id": make_cursor(inode, tag, pos), "timestamp": timestamp, "narrative": narrative})
+            if len(records) >= limit: rows.close(); return records
+    return records
+
+
+def _summarized(lines, f):
+    """(offset, timestamp, narrative) for each (offset, line), closing f once the caller is done."""
+    with f:
+        for offset, line in lines: yield (offset,) + summarize_line(line)
+
+
+def iter_lines_forward(f):
+    """Yield (offset, line) for each complete line from the current position of f."""
+    pos = f.tell()
+    for line in iter(f.readline, b""):
+        if not line.endswith(b"\n"): f.seek(pos); return  # a record still being written; leave f before it
+        if line.strip(): yield pos, line.rstrip(b"\n")
+        pos += len(line)
@@ -0,0 +1,119 @@
+import logging
+import os
+import threading
+from collections import deque
+
+from app.history import first_line_tag, iter_lines_forward, make_cursor, summarize_line
+
+logger = logging.getLogger(__name__)
+
+
+class LiveFeed:
+    """Follows the narrative log and fans new records out to live-stream subscribers.
+
+    One tail thread per process reads whatever any worker has appended to the log (following it
+    across rotations). It wakes every `poll_interval` seconds, or immediately when `poke` is called
+    after a local commit. Records are kept in a small ring with increasing sequence numbers;
+    subscribers block in `wait` until there is something newer than the last sequence they saw.
+    Record ids are the same cursors /get_roll_history hands out.
+    """
+
+    def __init__(self, path, poll_interval=0.5, backlog=200):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._ring = deque(maxlen=backlog)  # (seq, record)
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._subscribers = 0
+        self.closed = False
+
+    # --- Subscriber side ---
+    @property
+    def seq(self):
+        with self._cond: return self._seq
+
+    def wait(self, after_seq, timeout):
+        """Return (records newer than after_seq, latest seq), waiting up to `timeout` seconds for one.
+
+        Returns at once once the feed is closed; streams should check `closed` and end.
+        """
+        self._ensure_started()
+        with self._cond:
+            if self._seq <= after_seq and not self.closed: self._cond.wait(timeout)
+            oldest = self._ring[0][0] if self._ring else self._seq + 1
+            if after_seq + 1 < oldest and self._ring: logger.warning(f"Live feed subscriber fell {oldest - after_seq - 1} records behind; skipping them.")
+            return [record for seq, record in self._ring if seq > after_seq], self._seq
+
+    def acquire_slot(self, limit):
+        with self._cond:
+            if self._subscribers >= limit: return False
+            self._subscribers += 1
+            return True
+
+    def release_slot(self):
+        with self._cond: self._subscribers -= 1
+
+    def close(self):
+        """Wake every subscriber and make them end, so open streams do not hold up a worker's shutdown."""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def poke(self, *_args):
+        """Ask the tail thread to look for new records now (used as a NarrativeLogWriter listener)."""
+        self._wake.set()
+
+    # --- Tail thread ---
+    def start(self):
+        """Start following the log; records appended from this call on will be published."""
+        self._ensure_started()
+
+    def _ensure_started(self):
+        if self._thread is not None and self._pid == os.getpid(): return
+        with self._cond:
+            if self._thread is not None and self._pid == os.getpid(): return
+            self._pid = os.getpid()
+            # Open at the current end before returning, so nothing appended after start() is missed
+            try:
+                f = open(self.path, "rb"); f.seek(0, os.SEEK_END)
+            except FileNotFoundError: f = None
+            self._thread = threading.Thread(target=self._run, args=(f,), name="live-feed", daemon=True)
+            self._thread.start()
+
+    def _run(self, f):
+        inode = os.fstat(f.fileno()).st_ino if f is not None else None
+        tag = None
+        while True:
+            try:
+                if f is None:
+                    # A log (re)created after we started is new from its first line
+                    try: f = open(self.path, "rb"); inode = os.fstat(f.fileno()).st_ino
+                    except FileNotFoundError: f = None
+                if f is not None:
+                    tag = self._publish(f, inode, tag)
+                    try: current = os.stat(self.path).st_ino
+                    except FileNotFoundError: current = None
+                    if current != inode:
+                        # Rotated: drain what was appended to the old file, then follow the new one from its start
+                        self._publish(f, inode, tag); f.close()
+                        f, inode, tag = None, None, None
+                        continue
+            except Exception as e: logger.error(f"Live feed tail error: {e}", exc_info=True)
+            self._wake.wait(self.poll_interval); self._wake.clear()
+
+    def _publish(self, f, inode, tag):
+        """Publish the complete lines appended to f; returns f's first-line tag once it is known."""
+        records = []
+        for pos, line in iter_lines_forward(f):
+            timestamp, narrative = summarize_line(line)
+            if narrative: records.append((pos, timestamp, narrative))
+        if not records: return tag
+        if tag is None: tag = first_line_tag(f)  # complete by now, as a line after it is
+        records = [{"id": make_cursor(inode, tag, pos), "timestamp": timestamp, "narrative": narrative} for pos, timestamp, narrative in records]
+        with self._cond:
+            for record in records:
+                self._seq += 1; self._ring.append((self._seq, record))
+            self._cond.notify_all()
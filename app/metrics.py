@@ -0,0 +1,128 @@
+import collections
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context
+
+# Latency buckets in seconds, from sub-millisecond table lookups to multi-second network calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)] + [f'{n}="{v}"' for n, v in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help_text, self.labels = name, help_text, tuple(labels)
+        self._values = collections.defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(n, "") for n in self.labels)
+        with self._lock: self._values[key] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock: items = sorted(self._values.items())
+        lines += [f"{self.name}{_label_text(self.labels, key)} {value:g}" for key, value in items]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.help_text, self.labels, self.buckets = name, help_text, tuple(labels), tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(n, "") for n in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None: series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound: series[i] += 1
+            series[-2] += value; series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock: items = sorted((k, list(v)) for k, v in self._series.items())
+        for key, series in items:
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{_label_text(self.labels, key, [('le', f'{bound:g}')])} {count}")
+            lines.append(f"{self.name}_bucket{_label_text(self.labels, key, [('le', '+Inf')])} {series[-1]}")
+            lines.append(f"{self.name}_sum{_label_text(self.labels, key)} {series[-2]:.6f}")
+            lines.append(f"{self.name}_count{_label_text(self.labels, key)} {series[-1]}")
+        return lines
+
+
+# --- Registry ---
+# Metrics are per process; with several gunicorn workers each scrape sees the worker that answered.
+STAGE_SECONDS = Histogram("crits_stage_duration_seconds", "Time spent in each stage of request handling and background work.", ["stage"])
+REQUEST_SECONDS = Histogram("crits_request_duration_seconds", "End-to-end request latency by endpoint.", ["endpoint", "status"])
+ROLLS_TOTAL = Counter("crits_rolls_total", "Rolls resolved, by context, type, source and outcome.", ["context", "roll_type", "source", "status"])
+ERRORS_TOTAL = Counter("crits_errors_total", "Errors by where they happened.", ["where"])
+REGISTRY = [STAGE_SECONDS, REQUEST_SECONDS, ROLLS_TOTAL, ERRORS_TOTAL]
+
+
+def render_metrics():
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+@contextmanager
+def stage(name):
+    """Time a block into the stage histogram and, inside a request, into its Server-Timing header."""
+    start = time.perf_counter()
+    try: yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        if has_request_context():
+            timings = g.setdefault("stage_timings", [])
+            timings.append((name, elapsed))
+
+
+def server_timing_header(timings, total=None):
+    parts = [f"{name};dur={elapsed * 1000:.2f}" for name, elapsed in timings]
+    if total is not None: parts.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(parts)
+
+
+# --- Sampling profiler ---
+class SamplingProfiler:
+    """Samples one thread's stack every `interval` seconds; results are folded stacks for flame graphs."""
+
+    def __init__(self, thread_id, interval=0.001):
+        self.thread_id, self.interval = thread_id, interval
+        self.samples = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set(); self._thread.join()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            if stack: self.samples[";".join(reversed(stack))] += 1
+
+    def folded(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
@@ -0,0 +1,216 @@
+import datetime
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from app.archive import ARCHIVE_EXT, is_archive
+from app.history import first_line_tag, line_tag
+from app.metrics import ERRORS_TOTAL, stage
+
+try:
+    import fcntl
+except ImportError:  # Windows dev boxes: single-process only, no cross-process locking
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+_FLUSH = object()
+_STOP = object()
+
+
+class NarrativeLogWriter:
+    """Background group-commit writer for the narrative JSONL log.
+
+    `append` only enqueues; a writer thread gathers entries for up to `flush_interval` seconds and
+    writes each batch with a single O_APPEND write while holding an exclusive flock on a sidecar
+    `.lock` file, so lines from different gunicorn workers never interleave.
+
+    fsync_policy is "always" (fsync every batch), "never" (leave it to the OS) or a number of seconds
+    between fsyncs. rotate is "size" (once the file reaches max_bytes), "daily" (when the UTC day of the
+    last write changes) or "off"; rotated segments are renamed to `<name>.<UTC stamp>.jsonl`.
+
+    If `recent` (a shared_state.RecentRolls) is given, each batch is also published to it while the
+    lock is still held, so the ring sees records in exactly the order the file has them.
+    """
+
+    def __init__(self, path, flush_interval=0.2, max_batch=512, fsync_policy="never",
+                 rotate="size", max_bytes=10 * 1024 * 1024, max_queue=10000, recent=None):
+        self.path = path
+        self.recent = recent
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        if fsync_policy not in ("always", "never"):
+            # Checked here, not on the first commit, so a typo fails at startup instead of failing every write
+            try: fsync_policy = float(fsync_policy)
+            except (TypeError, ValueError): raise ValueError(f"fsync_policy must be 'always', 'never' or a number of seconds, not {fsync_policy!r}") from None
+        self.fsync_policy = fsync_policy
+        self.rotate = rotate
+        self.max_bytes = max_bytes
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._listeners = []
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._fd = None
+        self._tag = None  # first-line tag of the file self._fd is open on (see app.history)
+        self._lock_fd = None
+        self._last_fsync = 0.0
+
+    # --- Public API ---
+    def append(self, entry):
+        """Queue one log record (a JSON-serialisable dict) for the next group commit."""
+        self._ensure_started()
+        self._queue.put(entry)
+
+    def extend(self, entries):
+        """Queue several records so they land in the same group commit."""
+        self._ensure_started()
+        self._queue.put(list(entries))
+
+    def flush(self, timeout=None):
+        """Block until everything queued before this call is on disk (or timeout); returns True on success."""
+        self._ensure_started()
+        done = threading.Event()
+        self._queue.put((_FLUSH, done))
+        return done.wait(timeout)
+
+    def close(self, timeout=5):
+        if self._thread is None or self._pid != os.getpid(): return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def add_listener(self, callback):
+        """Register callback(entries) run on the writer thread after each batch is committed."""
+        self._listeners.append(callback)
+
+    def segments(self):
+        """Rotated segment paths, oldest first (the live file is not included).
+
+        A segment that has been compacted is listed by its archive rather than its JSONL file.
+        """
+        stem, ext = os.path.splitext(self.path)
+        by_stamp = {}
+        for path in glob.glob(f"{glob.escape(stem)}.*{ext}") + glob.glob(f"{glob.escape(stem)}.*{ARCHIVE_EXT}"):
+            stamp = os.path.splitext(path)[0][len(stem) + 1:]
+            if stamp not in by_stamp or is_archive(path): by_stamp[stamp] = path
+        return [by_stamp[stamp] for stamp in sorted(by_stamp)]
+
+    # --- Writer thread ---
+    # Started lazily and re-started after fork so each gunicorn worker owns its own thread and fds.
+    def _ensure_started(self):
+        if self._thread is not None and self._pid == os.getpid(): return
+        with self._start_lock:
+            if self._thread is not None and self._pid == os.getpid(): return
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self._queue.maxsize); self._fd = self._lock_fd = None
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="narrative-log-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            batch, waiters, stop = [], [], False
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is _STOP: stop = True
+                elif isinstance(item, tuple) and item and item[0] is _FLUSH: waiters.append(item[1])
+                elif isinstance(item, list): batch.extend(item)
+                else: batch.append(item)
+                if stop or waiters or len(batch) >= self.max_batch: break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: break
+                try: item = self._queue.get(timeout=remaining)
+                except queue.Empty: break
+            if batch:
+                try:
+                    with stage("log_commit"): self._commit(batch)
+                except Exception as e:
+                    ERRORS_TOTAL.inc(where="log_commit"); logger.error(f"Narrative log commit of {len(batch)} entries failed: {e}", exc_info=True)
+            for waiter in waiters: waiter.set()
+            if stop: self._close_fds(); return
+
+    def _commit(self, batch):
+        lines, kept = [], []
+        for entry in batch:
+            try: lines.append(json.dumps(entry) + "\n"); kept.append(entry)
+            except (TypeError, ValueError) as e: logger.error(f"Dropping unserialisable log entry: {e}")
+        if not lines: return
+        encoded = [line.encode("utf-8") for line in lines]
+        data = b"".join(encoded)
+        self._lock()
+        try:
+            self._maybe_rotate()
+            fd = self._open()
+            start = os.lseek(fd, 0, os.SEEK_END)  # where O_APPEND will put this batch, as we hold the lock
+            try:
+                view = memoryview(data)
+                while view: view = view[os.write(fd, view):]
+                self._maybe_fsync(fd)
+                if self.recent is not None: self._publish_recent(fd, start, encoded, kept)
+            except Exception:
+                # A half-written batch must not leave the ring claiming it holds every recent record
+                if self.recent is not None: self.recent.clear()
+                raise
+        finally: self._unlock()
+        for callback in self._listeners:
+            try: callback(kept)
+            except Exception as e: logger.error(f"Narrative log listener failed: {e}", exc_info=True)
+
+    def _publish_recent(self, fd, start, encoded, entries):
+        if self._tag is None:
+            # The file's first line is ours when the batch starts it; otherwise read it back (we hold the lock, so path is fd's file)
+            if start == 0: self._tag = line_tag(encoded[0])
+            else:
+                with open(self.path, "rb") as f: self._tag = first_line_tag(f)
+        inode, items, offset = os.fstat(fd).st_ino, [], start
+        for line, entry in zip(encoded, entries):
+            if entry.get("narrative"): items.append((inode, self._tag, offset, entry.get("timestamp"), entry["narrative"]))  # history skips the rest
+            offset += len(line)
+        self.recent.publish(items)
+
+    def _open(self):
+        # Another worker may have rotated the file since we opened it; follow the path, not the inode.
+        if self._fd is not None:
+            try: current = os.stat(self.path)
+            except FileNotFoundError: current = None
+            if current is None or current.st_ino != os.fstat(self._fd).st_ino: os.close(self._fd); self._fd = None
+        if self._fd is None: self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644); self._tag = None
+        return self._fd
+
+    def _maybe_fsync(self, fd):
+        if self.fsync_policy == "never": return
+        now = time.monotonic()
+        if self.fsync_policy == "always" or now - self._last_fsync >= self.fsync_policy:
+            os.fsync(fd); self._last_fsync = now
+
+    def _maybe_rotate(self):
+        if self.rotate == "off": return
+        try: st = os.stat(self.path)
+        except FileNotFoundError: return
+        if st.st_size == 0: return
+        if self.rotate == "size": due = st.st_size >= self.max_bytes
+        else: due = datetime.datetime.fromtimestamp(st.st_mtime, datetime.timezone.utc).date() != datetime.datetime.now(datetime.timezone.utc).date()
+        if not due: return
+        stem, ext = os.path.splitext(self.path)
+        stamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+        os.rename(self.path, f"{stem}.{stamp}{ext}")
+        logger.info(f"Rotated narrative log to {stem}.{stamp}{ext}")
+
+    def _lock(self):
+        if fcntl is None: return
+        if self._lock_fd is None: self._lock_fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+
+    def _unlock(self):
+        if fcntl is not None and self._lock_fd is not None: fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _close_fds(self):
+        for fd in (self._fd, self._lock_fd):
+            if fd is not None: os.close(fd)
+        self._fd = self._lock_fd = None
@@ -0,0 +1,389 @@
+"""Memory shared by every gunicorn worker, mapped from one file created before the workers fork.
+
+The file has four regions:
+
+* tables – the master crit/fumble JSON, stored once as canonical bytes in two slots. A reload fills the
+  idle slot, then flips the active slot and bumps a generation counter, so readers always see one
+  complete version.
+* recent rolls – a fixed ring of the newest narrative records, filled by the log writer while it holds
+  the log lock (so ring order is file order), and read by /get_roll_history.
+* geolocation – a set-associative cache of lookup results with absolute expiry times.
+* deliveries – the status of recent Discord shares, so any worker can answer a status poll.
+
+Each region has its own lock: a thread lock plus an flock on a sidecar file, shared for reads and
+exclusive for writes.
+"""
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+from app.history import make_cursor, parse_cursor
+from app.tables import compile_crit_data, compile_fumble_data
+
+try:
+    import fcntl
+except ImportError:  # Windows dev boxes: single-process only, no cross-process locking
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SHARED_STATE_ENV = "CRITS_SHARED_STATE"
+MAGIC = b"CRSH"
+LAYOUT_VERSION = 3
+
+_HEADER = struct.Struct("<4sIIIIII")      # magic, layout version, table slot bytes, ring slots, ring slot bytes, geo slots, delivery slots
+_TABLES = struct.Struct("<QB40s")         # generation, active slot, source file signature
+_TABLE_SLOT = struct.Struct("<I12s")      # data length, data version
+_RING = struct.Struct("<Q")               # records ever published
+_RING_SLOT = struct.Struct("<QQIQI")      # seq + 1 (0 = empty), inode, file tag, offset, payload length
+_GEO_SLOT = struct.Struct("<dB63sH")      # expires (wall clock), key length, key, value length
+GEO_SLOT_BYTES = 256
+GEO_WAYS = 4
+_DELIVERY_SLOT = struct.Struct("<16sdBH")  # delivery id (uuid bytes), updated (wall clock), status, error length
+DELIVERY_SLOT_BYTES = 256
+DELIVERY_STATUSES = ("queued", "sending", "sent", "failed")
+OVERFLOW = 0xFFFFFFFF                     # ring payload too large for a slot; readers go to the log file
+
+
+def _align(n, to=64):
+    return (n + to - 1) // to * to
+
+
+def _layout(table_slot_bytes, ring_slots, ring_slot_bytes, geo_slots, delivery_slots):
+    """Offsets of the tables, ring, geo and delivery regions, and the total file size."""
+    tables_off = 64
+    ring_off = _align(tables_off + 64 + 2 * (_TABLE_SLOT.size + table_slot_bytes))
+    geo_off = _align(ring_off + 64 + ring_slots * ring_slot_bytes)
+    delivery_off = geo_off + geo_slots * GEO_SLOT_BYTES
+    return tables_off, ring_off, geo_off, delivery_off, delivery_off + delivery_slots * DELIVERY_SLOT_BYTES
+
+
+def default_path(base=None):
+    """A per-process file name in `base`, by default /dev/shm (or the temp dir where there is none)."""
+    base = base or ("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir())
+    return os.path.join(base, f"crits-shared-{os.getpid()}")
+
+
+def configured_path():
+    """SHARED_STATE_PATH as a file path; a directory there gets a per-process file name inside it."""
+    path = os.environ.get("SHARED_STATE_PATH")
+    if not path: return default_path()
+    return default_path(path) if os.path.isdir(path) else path
+
+
+class _RegionLock:
+    """Thread lock plus a per-process flock on `path`; flock is per open file, not per thread, hence both."""
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.Lock()
+        self._fd = None
+        self._pid = None
+
+    @contextmanager
+    def __call__(self, exclusive=True):
+        with self._thread_lock:
+            if fcntl is None: yield; return
+            if self._pid != os.getpid(): self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644); self._pid = os.getpid()
+            fcntl.flock(self._fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try: yield
+            finally: fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+# --- Tables ---
+def file_signature(paths):
+    parts = []
+    for path in paths:
+        try: st = os.stat(path); parts.append(f"{path}:{st.st_ino}:{st.st_mtime_ns}:{st.st_size}")
+        except FileNotFoundError: parts.append(f"{path}:missing")
+    return hashlib.sha1("|".join(parts).encode()).hexdigest().encode()
+
+
+def data_version(data):
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+class SharedTables:
+    def __init__(self, buf, offset, slot_bytes, lock):
+        self._buf, self._offset, self.slot_bytes, self._lock = buf, offset, slot_bytes, lock
+        self._next_check = 0.0
+
+    def _slot_offset(self, slot):
+        return self._offset + 64 + slot * (_TABLE_SLOT.size + self.slot_bytes)
+
+    @property
+    def generation(self):
+        return struct.unpack_from("<Q", self._buf, self._offset)[0]
+
+    def read(self):
+        """Return (generation, [crit_data, fumble_data], data version) of the active slot."""
+        with self._lock(exclusive=False):
+            generation, active, _ = _TABLES.unpack_from(self._buf, self._offset)
+            if generation == 0: return 0, [{}, {}], None
+            pos = self._slot_offset(active)
+            length, version = _TABLE_SLOT.unpack_from(self._buf, pos)
+            data = bytes(self._buf[pos + _TABLE_SLOT.size:pos + _TABLE_SLOT.size + length])
+        return generation, json.loads(data), version.decode()
+
+    def maybe_reload(self, paths, interval):
+        """Reload from `paths` if they changed since the last load; checks at most every `interval` seconds."""
+        if interval <= 0: return False
+        now = time.monotonic()
+        if now < self._next_check: return False
+        self._next_check = now + interval
+        with self._lock(exclusive=False): current = _TABLES.unpack_from(self._buf, self._offset)[2]
+        return current != file_signature(paths) and self.reload(paths)
+
+    def reload(self, paths, force=False):
+        """Load the JSON files into the idle slot and make it active; returns True if a new version was published.
+
+        Files that do not parse or compile are rejected and the current tables stay active. When nothing
+        has been loaded yet, an unreadable file is treated as empty, the same as the app always has.
+        """
+        with self._lock():
+            generation, active, current = _TABLES.unpack_from(self._buf, self._offset)
+            signature = file_signature(paths)
+            if not force and generation and signature == current: return False
+            tables = []
+            for path in paths:
+                try:
+                    with open(path) as f: tables.append(json.load(f))
+                except (OSError, ValueError) as e:
+                    if generation: logger.error(f"Not reloading tables: could not read {path}: {e}"); return self._reject(signature)
+                    logger.error(f"Error: could not load JSON from {path}: {e}"); tables.append({})
+            try: compile_crit_data(tables[0]); compile_fumble_data(tables[1])
+            except Exception as e:
+                if generation: logger.error(f"Not reloading tables: they do not compile: {e}"); return self._reject(signature)
+                raise
+            data = json.dumps(tables, sort_keys=True).encode()
+            if len(data) > self.slot_bytes:
+                if not generation: raise ValueError(f"Roll tables ({len(data)} bytes) do not fit the {self.slot_bytes}-byte shared slot; raise SHARED_TABLES_BYTES")
+                logger.error(f"Not reloading tables: {len(data)} bytes exceeds the {self.slot_bytes}-byte shared slot (raise SHARED_TABLES_BYTES)")
+                return self._reject(signature)
+            target = 1 - active if generation else 0
+            pos = self._slot_offset(target)
+            _TABLE_SLOT.pack_into(self._buf, pos, len(data), data_version(data).encode())
+            self._buf[pos + _TABLE_SLOT.size:pos + _TABLE_SLOT.size + len(data)] = data
+            _TABLES.pack_into(self._buf, self._offset, generation + 1, target, signature)
+        logger.info(f"Published roll tables version {data_version(data)} (generation {generation + 1})")
+        return True
+
+    def _reject(self, signature):
+        # Remember the bad files' signature so workers stop retrying until they change again
+        generation, active, _ = _TABLES.unpack_from(self._buf, self._offset)
+        _TABLES.pack_into(self._buf, self._offset, generation, active, signature)
+        return False
+
+
+# --- Recent rolls ---
+class RecentRolls:
+    def __init__(self, buf, offset, slots, slot_bytes, lock):
+        self._buf, self._offset, self.slots, self.slot_bytes, self._lock = buf, offset, slots, slot_bytes, lock
+
+    def _slot_offset(self, seq):
+        return self._offset + 64 + (seq % self.slots) * self.slot_bytes
+
+    def publish(self, items):
+        """Append [(inode, tag, offset, timestamp, narrative)] in log order (callers hold the log lock)."""
+        room = self.slot_bytes - _RING_SLOT.size
+        with self._lock():
+            head = _RING.unpack_from(self._buf, self._offset)[0]
+            for inode, tag, offset, timestamp, narrative in items:
+                payload = json.dumps([timestamp, narrative]).encode()
+                pos = self._slot_offset(head)
+                if len(payload) > room: _RING_SLOT.pack_into(self._buf, pos, head + 1, inode, tag, offset, OVERFLOW)
+                else:
+                    _RING_SLOT.pack_into(self._buf, pos, head + 1, inode, tag, offset, len(payload))
+                    self._buf[pos + _RING_SLOT.size:pos + _RING_SLOT.size + len(payload)] = payload
+                head += 1
+            _RING.pack_into(self._buf, self._offset, head)
+
+    def clear(self):
+        """Forget every record (after a failed commit, so the ring never skips one the log has)."""
+        with self._lock():
+            head = _RING.unpack_from(self._buf, self._offset)[0]
+            for seq in range(max(0, head - self.slots), head): _RING_SLOT.pack_into(self._buf, self._slot_offset(seq), 0, 0, 0, 0, 0)
+
+    def read(self, before=None, limit=50):
+        """Newest-first records older than `before`, or None when the ring does not hold that cursor.
+
+        Fewer than `limit` records means the ring ran out; the caller continues from the log files.
+        """
+        want = parse_cursor(before) if before else None
+        found, raw = want is None, []
+        with self._lock(exclusive=False):
+            head = _RING.unpack_from(self._buf, self._offset)[0]
+            for seq in range(head - 1, max(0, head - self.slots) - 1, -1):
+                pos = self._slot_offset(seq)
+                stored, inode, tag, offset, length = _RING_SLOT.unpack_from(self._buf, pos)
+                if stored != seq + 1: break
+                if not found: found = (inode, tag, offset) == want; continue
+                if length == OVERFLOW: break
+                raw.append((inode, tag, offset, bytes(self._buf[pos + _RING_SLOT.size:pos + _RING_SLOT.size + length])))
+                if len(raw) >= limit: break
+        if not found: return None
+        records = []
+        for inode, tag, offset, payload in raw:
+            timestamp, narrative = json.loads(payload)
+            records.append({"id": make_cursor(inode, tag, offset), "timestamp": timestamp, "narrative": narrative})
+        return records
+
+
+# --- Geolocation cache ---
+class SharedGeoCache:
+    def __init__(self, buf, offset, slots, lock):
+        self._buf, self._offset, self.slots, self._lock = buf, offset, slots - slots % GEO_WAYS, lock
+
+    def _ways(self, key):
+        first = zlib.crc32(key) % (self.slots // GEO_WAYS) * GEO_WAYS
+        return [self._offset + (first + i) * GEO_SLOT_BYTES for i in range(GEO_WAYS)]
+
+    def get(self, ip_address):
+        """Return (seconds left, geo_info) for a live entry, else None."""
+        key = ip_address.encode()[:63]
+        with self._lock(exclusive=False):
+            for pos in self._ways(key):
+                expires, key_len, stored, value_len = _GEO_SLOT.unpack_from(self._buf, pos)
+                if key_len == len(key) and stored[:key_len] == key:
+                    remaining = expires - time.time()
+                    if remaining <= 0: return None
+                    return remaining, json.loads(bytes(self._buf[pos + _GEO_SLOT.size:pos + _GEO_SLOT.size + value_len]))
+        return None
+
+    def put(self, ip_address, geo_info, ttl):
+        key = ip_address.encode()
+        value = json.dumps(geo_info).encode()
+        if len(key) > 63 or len(value) > GEO_SLOT_BYTES - _GEO_SLOT.size: return
+        now = time.time()
+        with self._lock():
+            candidates = []
+            for pos in self._ways(key):
+                expires, key_len, stored, _ = _GEO_SLOT.unpack_from(self._buf, pos)
+                if key_len == len(key) and stored[:key_len] == key: candidates = [(-1, pos)]; break
+                candidates.append((expires if expires > now else 0, pos))  # empty or expired slots go first
+            pos = min(candidates)[1]
+            _GEO_SLOT.pack_into(self._buf, pos, now + ttl, len(key), key, len(value))
+            self._buf[pos + _GEO_SLOT.size:pos + _GEO_SLOT.size + len(value)] = value
+
+
+# --- Discord delivery statuses ---
+class SharedDeliveryStatuses:
+    """Status of recent Discord deliveries by id, set-associative like the geo cache; the least recently
+    updated entry of a set makes room for a new one."""
+
+    def __init__(self, buf, offset, slots, lock):
+        self._buf, self._offset, self.slots, self._lock = buf, offset, slots - slots % GEO_WAYS, lock
+
+    def _ways(self, key):
+        first = zlib.crc32(key) % (self.slots // GEO_WAYS) * GEO_WAYS
+        return [self._offset + (first + i) * DELIVERY_SLOT_BYTES for i in range(GEO_WAYS)]
+
+    def get(self, delivery_id):
+        """Return {"status", "error"} for a known delivery id, else None."""
+        try: key = bytes.fromhex(delivery_id)
+        except ValueError: return None
+        if len(key) != 16 or not self.slots: return None
+        with self._lock(exclusive=False):
+            for pos in self._ways(key):
+                stored, _, status, error_len = _DELIVERY_SLOT.unpack_from(self._buf, pos)
+                if stored == key and status:
+                    error = bytes(self._buf[pos + _DELIVERY_SLOT.size:pos + _DELIVERY_SLOT.size + error_len]).decode("utf-8", errors="replace")
+                    return {"status": DELIVERY_STATUSES[status - 1], "error": error or None}
+        return None
+
+    def set(self, delivery_id, status, error=None):
+        key = bytes.fromhex(delivery_id)
+        if len(key) != 16 or not self.slots: return
+        error = (error or "").encode("utf-8")[:DELIVERY_SLOT_BYTES - _DELIVERY_SLOT.size]
+        now = time.time()
+        with self._lock():
+            candidates = []
+            for pos in self._ways(key):
+                stored, updated, code, _ = _DELIVERY_SLOT.unpack_from(self._buf, pos)
+                if stored == key: candidates = [(-1, pos)]; break
+                candidates.append((updated if code else 0, pos))  # empty slots go first
+            pos = min(candidates)[1]
+            _DELIVERY_SLOT.pack_into(self._buf, pos, key, now, DELIVERY_STATUSES.index(status) + 1, len(error))
+            self._buf[pos + _DELIVERY_SLOT.size:pos + _DELIVERY_SLOT.size + len(error)] = error
+
+
+# --- The shared file ---
+class SharedState:
+    def __init__(self, path, buf, table_slot_bytes, ring_slots, ring_slot_bytes, geo_slots, delivery_slots):
+        self.path, self._buf = path, buf
+        tables_off, ring_off, geo_off, delivery_off, self.size = _layout(table_slot_bytes, ring_slots, ring_slot_bytes, geo_slots, delivery_slots)
+        self.tables = SharedTables(buf, tables_off, table_slot_bytes, _RegionLock(path + ".tables.lock"))
+        self.recent = RecentRolls(buf, ring_off, ring_slots, ring_slot_bytes, _RegionLock(path + ".ring.lock"))
+        self.geo = SharedGeoCache(buf, geo_off, geo_slots, _RegionLock(path + ".geo.lock"))
+        self.deliveries = SharedDeliveryStatuses(buf, delivery_off, delivery_slots, _RegionLock(path + ".deliveries.lock"))
+        self._owner = None
+
+    @classmethod
+    def create(cls, path, table_slot_bytes=1 << 20, ring_slots=1024, ring_slot_bytes=1024, geo_slots=4096, delivery_slots=1024):
+        """Create (or reset) the shared file at `path` and map it; the creating process removes it at exit."""
+        size = _layout(table_slot_bytes, ring_slots, ring_slot_bytes, geo_slots, delivery_slots)[4]
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, size)
+            buf = mmap.mmap(fd, size)
+        finally: os.close(fd)
+        _HEADER.pack_into(buf, 0, MAGIC, LAYOUT_VERSION, table_slot_bytes, ring_slots, ring_slot_bytes, geo_slots, delivery_slots)
+        state = cls(path, buf, table_slot_bytes, ring_slots, ring_slot_bytes, geo_slots, delivery_slots)
+        state._owner = os.getpid()
+        return state
+
+    @classmethod
+    def attach(cls, path):
+        """Map a file made by `create` in another process (normally the gunicorn master)."""
+        fd = os.open(path, os.O_RDWR)
+        try: buf = mmap.mmap(fd, os.fstat(fd).st_size)
+        finally: os.close(fd)
+        magic, version, *layout = _HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != LAYOUT_VERSION: raise ValueError(f"{path} is not a shared state file of layout {LAYOUT_VERSION}")
+        return cls(path, buf, *layout)
+
+    def remove(self):
+        """Delete the file and its lock files (only in the process that created them)."""
+        if self._owner != os.getpid(): return
+        for path in (self.path, self.path + ".tables.lock", self.path + ".ring.lock", self.path + ".geo.lock", self.path + ".deliveries.lock"):
+            try: os.remove(path)
+            except FileNotFoundError: pass
+
+
+def _layout_from_env():
+    return dict(table_slot_bytes=int(os.environ.get("SHARED_TABLES_BYTES", 1 << 20)),
+                ring_slots=int(os.environ.get("SHARED_RECENT_ROLLS", 1024)),
+                ring_slot_bytes=int(os.environ.get("SHARED_RECENT_SLOT_BYTES", 1024)),
+                geo_slots=int(os.environ.get("SHARED_GEO_SLOTS", 4096)),
+                delivery_slots=int(os.environ.get("SHARED_DELIVERY_SLOTS", 1024)))
+
+
+def prepare_shared_state(table_paths, path=None):
+    """Create the shared state and load the tables into it; call in the gunicorn master before it forks.
+
+    The path is exported in the environment so workers (and anything else forked later) attach to it.
+    """
+    state = SharedState.create(path or configured_path(), **_layout_from_env())
+    state.tables.reload(table_paths, force=True)
+    os.environ[SHARED_STATE_ENV] = state.path
+    return state
+
+
+def open_shared_state(table_paths):
+    """Attach to the state the master prepared or, when there is none (flask run, gunicorn without the
+    config hook), prepare one for this process and its children."""
+    path = os.environ.get(SHARED_STATE_ENV)
+    if path:
+        try: return SharedState.attach(path)
+        except (OSError, ValueError) as e: logger.error(f"Could not attach shared state at {path}: {e}; using a private copy")
+    # Never a configured SHARED_STATE_PATH file here: every worker would truncate the same one
+    configured = os.environ.get("SHARED_STATE_PATH")
+    return prepare_shared_state(table_paths, default_path(configured if configured and os.path.isdir(configured) else None))
@@ -0,0 +1,145 @@
+import json
+import logging
+import os
+import threading
+from collections import Counter
+
+try:
+    import fcntl
+except ImportError:  # Windows dev boxes: single-process only, no cross-process locking
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+def roll_facts(entry):
+    """The typed facts of one narrative log entry, pulled from its raw_payload/raw_response.
+
+    Returns a dict with context, rollType, source, table, damageType, rollValue, secondaryType and result;
+    missing values are None. "table" is the key the roll was looked up under (crit damage key, fumble attack
+    type, or effect table for secondary rolls).
+    """
+    payload = entry.get("raw_payload") or {}
+    response = entry.get("raw_response") or {}
+    context = payload.get("rollContext", "primary")
+    roll_type = payload.get("rollType")
+    source = table = damage_type = None
+    if context == "secondary":
+        table = roll_type
+        result = response.get("secondaryResultText")
+    elif roll_type == "crit":
+        source = response.get("selectedCritSource") or payload.get("critSource")
+        damage_type = payload.get("damageType")
+        table = payload.get("magicSubtype") if damage_type == "magic" and source == "Sterling Vermin" else damage_type
+        result = response.get("description") or response.get("resultText")
+    else:
+        source = response.get("selectedFumbleType") or payload.get("fumbleType")
+        table = payload.get("attackType")
+        result = response.get("description") or response.get("resultText")
+    roll_value = response.get("rollValue")
+    return {"context": context, "rollType": roll_type, "source": source, "table": table.lower() if isinstance(table, str) else table,
+            "damageType": damage_type, "rollValue": roll_value if isinstance(roll_value, int) else None,
+            "secondaryType": response.get("secondaryType"), "result": result}
+
+
+def _kind(facts):
+    return "secondary" if facts["context"] == "secondary" else facts["rollType"] or "unknown"
+
+
+def empty_stats():
+    return {"rolls": 0, "first": None, "last": None, "byKind": {}, "bySource": {}, "byTable": {}, "byDamageType": {}, "months": {}}
+
+
+def merge_facts(stats, timestamp, facts):
+    """Fold one roll into a stats dict (as produced by empty_stats) in place."""
+    def bump(counts, key, amount=1):
+        if key is not None: counts[key] = counts.get(key, 0) + amount
+
+    kind = _kind(facts)
+    source_key = f"{kind}/{facts['source']}" if facts["source"] else None
+    table_key = "/".join(str(part) for part in (kind, facts["source"], facts["table"]) if part)
+    stats["rolls"] += 1
+    if timestamp:
+        if stats["first"] is None or timestamp < stats["first"]: stats["first"] = timestamp
+        if stats["last"] is None or timestamp > stats["last"]: stats["last"] = timestamp
+    bump(stats["byKind"], kind); bump(stats["bySource"], source_key); bump(stats["byTable"], table_key)
+    bump(stats["byDamageType"], facts["damageType"])
+    month = stats["months"].setdefault(timestamp[:7] if timestamp else "unknown", {"rolls": 0, "bySource": {}, "results": {}})
+    month["rolls"] += 1
+    bump(month["bySource"], source_key)
+    if facts["result"]: bump(month["results"].setdefault(kind, {}), facts["result"])
+
+
+def summarize_stats(stats, top=5):
+    """The /stats view: totals plus each month's most common results per kind of roll."""
+    months = {}
+    for name, month in sorted(stats["months"].items()):
+        most_common = {kind: [{"result": text, "count": count} for text, count in Counter(results).most_common(top)]
+                       for kind, results in month["results"].items()}
+        months[name] = {"rolls": month["rolls"], "bySource": month["bySource"], "mostCommon": most_common}
+    return {**{k: v for k, v in stats.items() if k != "months"}, "months": months}
+
+
+class RollStats:
+    """Running aggregates over everything written to the narrative log, shared by all workers.
+
+    Registered as a NarrativeLogWriter listener, `record` folds each committed batch into a small JSON
+    sidecar under an flock and replaces it atomically, so /stats never has to rescan the log. `snapshot`
+    re-reads the sidecar only when another worker has changed it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._cached = (None, empty_stats())  # (stat signature, stats)
+        self._lock_fd = None
+        self._pid = None
+
+    def record(self, batch):
+        entries = [entry for entry in batch if isinstance(entry, dict)]
+        if not entries: return
+        with self._lock:
+            self._flock(True)
+            try:
+                stats = self._load()
+                for entry in entries: merge_facts(stats, entry.get("timestamp"), roll_facts(entry))
+                self._write(stats)
+            finally: self._flock(False)
+
+    def snapshot(self):
+        with self._lock: return self._load()
+
+    def replace(self, stats):
+        """Overwrite the aggregates (used when rebuilding them from archived history)."""
+        with self._lock:
+            self._flock(True)
+            try: self._write(stats)
+            finally: self._flock(False)
+
+    def _signature(self):
+        try: st = os.stat(self.path)
+        except FileNotFoundError: return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _load(self):
+        signature = self._signature()
+        if signature is None: return empty_stats()
+        if signature != self._cached[0]:
+            try:
+                with open(self.path) as f: self._cached = (signature, json.load(f))
+            except (OSError, ValueError) as e:
+                logger.error(f"Unreadable stats file {self.path}: {e}; starting from empty aggregates")
+                self._cached = (signature, empty_stats())
+        return json.loads(json.dumps(self._cached[1]))  # callers mutate what they get
+
+    def _write(self, stats):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f: json.dump(stats, f, separators=(",", ":"))
+        os.replace(tmp, self.path)
+        self._cached = (self._signature(), stats)
+
+    def _flock(self, acquire):
+        if fcntl is None: return
+        if self._pid != os.getpid(): self._lock_fd = None; self._pid = os.getpid()  # fds are per worker after fork
+        if self._lock_fd is None: self._lock_fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX if acquire else fcntl.LOCK_UN)
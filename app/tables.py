@@ -0,0 +1,116 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# --- Die sizes per table family ---
+# Crit sources roll the die the frontend animates; the secondary effects tables are always d20
+# and every fumble table is a d100.
+CRIT_DIE_FACES = {"Sterling Vermin": 20, "Questionable Arcana": 100, "BCoydog": 100, "effects_tables": 20}
+FUMBLE_DIE_FACES = 100
+
+
+class CompiledTable:
+    """A roll table flattened into a dense list indexed by die face (slot 0 is unused).
+
+    `ranges` keeps the valid source entries as (range_str, value) and `index` maps each face to the
+    entry that owns it (-1 for a gap), for code that needs outcomes rather than values. A table is
+    falsy when no face has an entry, like the empty dict or list it was compiled from.
+    """
+    __slots__ = ("name", "faces", "slots", "index", "ranges", "issues", "covered")
+
+    def __init__(self, name, faces):
+        self.name = name
+        self.faces = faces
+        self.slots = [None] * (faces + 1)
+        self.index = [-1] * (faces + 1)
+        self.ranges = []
+        self.issues = []
+        self.covered = 0
+
+    def __bool__(self):
+        return self.covered > 0
+
+    def lookup(self, roll_value):
+        if 1 <= roll_value <= self.faces: return self.slots[roll_value]
+        return None
+
+    def __repr__(self):
+        return f"<CompiledTable {self.name} d{self.faces}>"
+
+
+def parse_range(range_str):
+    """Parse '7', '07-08' or '100-100' into an inclusive (low, high) pair; raises ValueError if malformed."""
+    if not isinstance(range_str, str) or not range_str.strip(): raise ValueError(f"empty range {range_str!r}")
+    if '-' in range_str: low, high = map(int, range_str.split('-'))
+    else: low = high = int(range_str)
+    if low > high: raise ValueError(f"reversed range {range_str!r}")
+    return low, high
+
+
+def compile_table(name, entries, faces):
+    """Build a CompiledTable from (range_str, value) pairs, recording gaps, overlaps and malformed ranges.
+
+    On overlap the earlier entry keeps the face, matching the first-match scan this replaces.
+    """
+    table = CompiledTable(name, faces)
+    for range_str, value in entries:
+        try: low, high = parse_range(range_str)
+        except ValueError as e: table.issues.append(f"malformed range {range_str!r}: {e}"); continue
+        if low < 1 or high > faces: table.issues.append(f"range {range_str!r} falls outside d{faces}")
+        table.ranges.append((range_str, value))
+        for face in range(max(low, 1), min(high, faces) + 1):
+            if table.slots[face] is not None: table.issues.append(f"face {face} overlaps at {range_str!r}"); continue
+            table.slots[face] = value
+            table.index[face] = len(table.ranges) - 1
+    gaps = [face for face in range(1, faces + 1) if table.slots[face] is None]
+    table.covered = faces - len(gaps)
+    if gaps: table.issues.append(f"no entry for face(s) {', '.join(map(str, gaps))}")
+    return table
+
+
+def compile_crit_data(crit_data):
+    """Compile every crit source (and the effects tables) into {source: {table_key: CompiledTable}}."""
+    compiled = {}
+    for source, tables in crit_data.items():
+        faces = CRIT_DIE_FACES.get(source)
+        if faces is None: logger.warning(f"Unknown crit source '{source}' in table data; assuming d20."); faces = 20
+        compiled[source] = {key: compile_table(f"{source} / {key}", table.items(), faces)
+                            for key, table in tables.items() if isinstance(table, dict)}
+    return compiled
+
+
+def compile_fumble_data(fumble_data):
+    """Compile every fumble list into {source: {attack_key: CompiledTable}} holding the entry dicts."""
+    compiled = {}
+    for source, tables in fumble_data.items():
+        compiled[source] = {key: compile_table(f"{source} fumble / {key}", ((e.get('roll'), e) for e in entries), FUMBLE_DIE_FACES)
+                            for key, entries in tables.items() if isinstance(entries, list)}
+    return compiled
+
+
+# --- Secondary (chained) rolls ---
+# Crit text that mentions an injury or insanity chart prompts a d20 roll on the matching effects table.
+# The first match wins, so "minor injury ... major injury instead" prompts a minor injury.
+SECONDARY_EFFECT_TABLES = {"minor": "minor_injuries", "major": "major_injuries", "insanity": "insanities"}
+
+
+def secondary_type_for(text):
+    """Return 'minor', 'major', 'insanity' or None for a resolved crit text."""
+    if not isinstance(text, str): return None
+    lowered = text.lower()
+    if "minor injury" in lowered: return "minor"
+    if "major injury" in lowered: return "major"
+    if "insanity" in lowered: return "insanity"
+    return None
+
+
+def report_coverage(*compiled_sets):
+    """Log every coverage issue found while compiling; returns the number of issues."""
+    count = 0
+    for compiled in compiled_sets:
+        for tables in compiled.values():
+            for table in tables.values():
+                for issue in table.issues:
+                    logger.warning(f"Table coverage issue in {table.name}: {issue}")
+                    count += 1
+    return count
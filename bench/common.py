@@ -0,0 +1,106 @@
+"""Shared timing, result and baseline helpers for the benchmark scripts."""
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The option sets the UI offers, so generated traffic exercises every table
+CRIT_OPTIONS = {"Sterling Vermin": ["bludgeoning", "piercing", "slashing", "magic"],
+                "Questionable Arcana": ["weapon", "spell"], "BCoydog": ["melee", "ranged", "magic"]}
+SV_MAGIC_SUBTYPES = ["acid", "cold", "fire", "force", "lightning", "necrotic", "poison", "psychic", "radiant", "thunder"]
+FUMBLE_OPTIONS = {"Questionable Arcana": ["Weapon", "Magic"], "BCoydog": ["melee", "ranged", "magic"]}
+
+
+def crit_payload(rng, source=None):
+    source = source or rng.choice(sorted(CRIT_OPTIONS))
+    payload = {"rollContext": "primary", "rollType": "crit", "critSource": source, "damageType": rng.choice(CRIT_OPTIONS[source])}
+    if payload["damageType"] == "magic" and source == "Sterling Vermin": payload["magicSubtype"] = f"magic:{rng.choice(SV_MAGIC_SUBTYPES)}"
+    return payload
+
+
+def fumble_payload(rng, source=None):
+    source = source or rng.choice(sorted(FUMBLE_OPTIONS))
+    return {"rollContext": "primary", "rollType": "fumble", "fumbleType": source, "attackType": rng.choice(FUMBLE_OPTIONS[source])}
+
+
+def roll_payload(rng):
+    return crit_payload(rng) if rng.random() < 0.5 else fumble_payload(rng)
+
+
+def summarize(samples):
+    """Latency summary (seconds) for a list of per-operation timings."""
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {"n": len(ordered), "mean": statistics.fmean(ordered), "p50": pick(0.50), "p95": pick(0.95),
+            "p99": pick(0.99), "max": ordered[-1]}
+
+
+def time_calls(fn, repeat, warmup=100, batch=1):
+    """Call fn() `repeat` times (after a warmup) and return the per-call latency summary.
+
+    Sub-microsecond calls are timed `batch` at a time so timer overhead does not swamp them.
+    """
+    for _ in range(min(warmup, repeat)): fn()
+    samples = []
+    for _ in range(max(1, repeat // batch)):
+        start = time.perf_counter()
+        for _ in range(batch): fn()
+        samples.append((time.perf_counter() - start) / batch)
+    return summarize(samples)
+
+
+def metadata(seed, **extra):
+    try: commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError: commit = None
+    return {"python": sys.version.split()[0], "platform": platform.platform(), "commit": commit or None,
+            "seed": seed, "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), **extra}
+
+
+def write_results(results, meta, output=None):
+    payload = {"meta": meta, "results": results}
+    text = json.dumps(payload, indent=2, sort_keys=True)
+    if output:
+        with open(output, "w") as f: f.write(text + "\n")
+    return payload
+
+
+def compare(results, baseline_path, tolerance):
+    """Print each benchmark's p50 against the baseline; return the names that regressed beyond tolerance."""
+    with open(baseline_path) as f: baseline = json.load(f)["results"]
+    regressions = []
+    for name, current in sorted(results.items()):
+        base = baseline.get(name)
+        if not base: print(f"  {name:<48} new"); continue
+        ratio = current["p50"] / base["p50"] if base["p50"] else float("inf")
+        flag = "REGRESSED" if ratio > 1 + tolerance else ("improved" if ratio < 1 - tolerance else "")
+        print(f"  {name:<48} {base['p50'] * 1e6:10.1f}us -> {current['p50'] * 1e6:10.1f}us  x{ratio:5.2f} {flag}")
+        if flag == "REGRESSED": regressions.append(name)
+    return regressions
+
+
+def print_results(results):
+    for name, r in sorted(results.items()):
+        print(f"  {name:<48} p50 {r['p50'] * 1e6:10.1f}us  p95 {r['p95'] * 1e6:10.1f}us  p99 {r['p99'] * 1e6:10.1f}us  (n={r['n']})")
+
+
+def add_output_arguments(parser):
+    parser.add_argument("--seed", type=int, default=1234, help="RNG seed for repeatable runs (default 1234)")
+    parser.add_argument("--output", help="write machine-readable results to this JSON file")
+    parser.add_argument("--baseline", help="compare against a results JSON written by an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed p50 slowdown vs the baseline (default 0.10)")
+
+
+def finish(results, meta, args):
+    """Print, save and (optionally) compare results; returns the process exit code."""
+    print_results(results)
+    write_results(results, meta, args.output)
+    if args.baseline:
+        print(f"Compared with {args.baseline}:")
+        regressions = compare(results, args.baseline, args.tolerance)
+        if regressions: print(f"{len(regressions)} benchmark(s) regressed by more than {args.tolerance:.0%}"); return 1
+    return 0
@@ -0,0 +1,233 @@
+"""End-to-end load test against a local gunicorn.
+
+    python -m bench.load [--workers 2] [--threads 64] [--concurrency 32] [--duration 20] [--seed N]
+                         [--output results.json] [--baseline old.json]
+
+Starts stub ip-api.com and Discord webhook servers, launches the app under gunicorn pointed at
+them, and drives a seeded mix of /roll, /get_roll_history and /share_discord traffic from many
+client threads. Client IPs are public addresses drawn from a fixed pool so the geolocation cache
+sees a realistic mix of hits and misses.
+"""
+import argparse
+import ipaddress
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from bench.common import REPO_ROOT, add_output_arguments, finish, metadata, roll_payload, summarize
+
+DEFAULT_MIX = "roll=0.75,history=0.2,share=0.05"
+
+
+# --- Stub upstreams ---
+class StubServer:
+    """A threaded HTTP server answering every request with `respond(handler)`; counts requests."""
+
+    def __init__(self, respond):
+        self.requests = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self): stub._handle(self)
+            def do_POST(self): stub._handle(self)
+            def log_message(self, *args): pass
+
+        self._respond = respond
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, name="stub-server", daemon=True).start()
+
+    def _handle(self, handler):
+        length = int(handler.headers.get("Content-Length") or 0)
+        if length: handler.rfile.read(length)
+        with self._lock: self.requests += 1; count = self.requests
+        status, body, headers = self._respond(handler, count)
+        data = json.dumps(body).encode() if body is not None else b""
+        handler.send_response(status)
+        for name, value in headers.items(): handler.send_header(name, value)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def close(self):
+        self.server.shutdown(); self.server.server_close()
+
+
+def geo_stub(latency):
+    def respond(handler, _count):
+        time.sleep(latency)
+        ip = handler.path.split("/json/", 1)[-1].split("?", 1)[0]
+        return 200, {"status": "success", "city": "Benchton", "regionName": "Loadshire", "query": ip}, {}
+    return StubServer(respond)
+
+
+def webhook_stub(latency, rate_limit_every):
+    def respond(_handler, count):
+        time.sleep(latency)
+        if rate_limit_every and count % rate_limit_every == 0:
+            return 429, {"message": "You are being rate limited.", "retry_after": 0.25, "global": False}, {"Retry-After": "1"}
+        return 204, None, {}
+    return StubServer(respond)
+
+
+# --- Server under test ---
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0)); return s.getsockname()[1]
+
+
+def start_gunicorn(port, workers, threads, env):
+    cmd = [sys.executable, "-m", "gunicorn", "--worker-class", "gthread", "--workers", str(workers), "--threads", str(threads),
+           "--bind", f"127.0.0.1:{port}", "--log-level", "warning", "app.app:app"]
+    proc = subprocess.Popen(cmd, cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None: raise RuntimeError(f"gunicorn exited with status {proc.returncode}")
+        try:
+            if requests.get(f"{base}/metrics", timeout=1).ok: return proc, base
+        except requests.exceptions.RequestException: pass
+        time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError("gunicorn did not become ready within 30s")
+
+
+def stop_gunicorn(proc, timeout=120):
+    """Stop gracefully, so workers finish pending geolocations, log writes and Discord posts; returns the drain time."""
+    start = time.monotonic()
+    proc.terminate()
+    try: proc.wait(timeout)
+    except subprocess.TimeoutExpired: proc.kill(); proc.wait()
+    return time.monotonic() - start
+
+
+def count_log_lines(log_dir):
+    total = 0
+    for name in os.listdir(log_dir):
+        if name.endswith(".jsonl"):
+            with open(os.path.join(log_dir, name), "rb") as f: total += sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1 << 20), b""))
+    return total
+
+
+# --- Load ---
+def public_ip_pool(rng, size):
+    pool = set()
+    while len(pool) < size:
+        ip = ipaddress.ip_address(rng.getrandbits(32))
+        if ip.is_global: pool.add(str(ip))
+    return sorted(pool)
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in ("roll", "history", "share"): raise ValueError(f"Unknown operation in mix: {name!r}")
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+def client_loop(base, rng, mix, ips, deadline, max_requests, samples, lock):
+    """One simulated player: a keep-alive session issuing requests from the seeded mix until the deadline."""
+    session = requests.Session()
+    names, weights = list(mix), list(mix.values())
+    local = {name: [] for name in names}
+    statuses = {name: {} for name in names}
+    sent = 0
+    while time.monotonic() < deadline and (max_requests is None or sent < max_requests):
+        op = rng.choices(names, weights)[0]
+        headers = {"X-Forwarded-For": rng.choice(ips)}
+        start = time.perf_counter()
+        try:
+            if op == "roll": response = session.post(f"{base}/roll", json=roll_payload(rng), headers=headers, timeout=30)
+            elif op == "history": response = session.get(f"{base}/get_roll_history", params={"limit": 50}, headers=headers, timeout=30)
+            else: response = session.post(f"{base}/share_discord", json={"message": f"Benchmark share {rng.getrandbits(32):08x}"}, headers=headers, timeout=30)
+            status = str(response.status_code)
+        except requests.exceptions.RequestException as e: status = type(e).__name__
+        local[op].append(time.perf_counter() - start)
+        statuses[op][status] = statuses[op].get(status, 0) + 1
+        sent += 1
+    session.close()  # idle keep-alive connections would otherwise hold up gunicorn's graceful shutdown
+    with lock:
+        for name in names:
+            samples[name][0].extend(local[name])
+            for status, count in statuses[name].items(): samples[name][1][status] = samples[name][1].get(status, 0) + count
+
+
+def run_load(base, args):
+    rng = random.Random(args.seed)
+    ips = public_ip_pool(rng, args.ip_pool)
+    mix = parse_mix(args.mix)
+    samples = {name: ([], {}) for name in mix}
+    lock = threading.Lock()
+    per_client = -(-args.requests // args.concurrency) if args.requests else None
+    start = time.monotonic()
+    deadline = start + (args.duration if not args.requests else 3600)
+    threads = [threading.Thread(target=client_loop, args=(base, random.Random(f"{args.seed}-client-{i}"), mix, ips, deadline, per_client, samples, lock))
+               for i in range(args.concurrency)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    elapsed = time.monotonic() - start
+    endpoints = {"roll": "load.roll", "history": "load.get_roll_history", "share": "load.share_discord"}
+    results = {}
+    for name, (timings, statuses) in samples.items():
+        if not timings: continue
+        results[endpoints[name]] = {**summarize(timings), "rps": len(timings) / elapsed, "statuses": statuses}
+    return results, elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the roll service on a local gunicorn with stubbed upstreams.")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn worker processes (default 2)")
+    parser.add_argument("--threads", type=int, default=64, help="threads per gunicorn worker (default 64)")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent client threads (default 32)")
+    parser.add_argument("--duration", type=float, default=20, help="seconds to run (default 20)")
+    parser.add_argument("--requests", type=int, help="stop after about this many requests instead of after --duration")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"operation weights (default {DEFAULT_MIX})")
+    parser.add_argument("--ip-pool", type=int, default=500, help="distinct client IPs (default 500)")
+    parser.add_argument("--geo-latency", type=float, default=0.05, help="stub geolocation latency in seconds (default 0.05)")
+    parser.add_argument("--webhook-latency", type=float, default=0.05, help="stub webhook latency in seconds (default 0.05)")
+    parser.add_argument("--rate-limit-every", type=int, default=20, help="stub webhook answers every Nth post with a 429 (0 to disable)")
+    add_output_arguments(parser)
+    args = parser.parse_args(argv)
+
+    scratch = tempfile.mkdtemp(prefix="crits-load-")
+    geo, webhook, proc = geo_stub(args.geo_latency), webhook_stub(args.webhook_latency, args.rate_limit_every), None
+    try:
+        env = dict(os.environ, LOG_STORAGE_DIR=scratch, GEO_API_URL=f"{geo.url}/json/{{ip}}", DISCORD_WEBHOOK_URL=f"{webhook.url}/webhook",
+                   PYTHONPATH=REPO_ROOT)
+        proc, base = start_gunicorn(free_port(), args.workers, args.threads, env)
+        print(f"Driving {base} with {args.concurrency} clients ({args.mix})...", file=sys.stderr)
+        results, elapsed = run_load(base, args)
+        print("Load finished; waiting for gunicorn to drain background work...", file=sys.stderr)
+        # Time until every queued geolocation, narrative write and share has gone out
+        drain = stop_gunicorn(proc); proc = None
+        meta = metadata(args.seed, suite="load", elapsed=elapsed, drain_seconds=drain, workers=args.workers, threads=args.threads,
+                        concurrency=args.concurrency, mix=args.mix, geo_requests=geo.requests, webhook_requests=webhook.requests,
+                        logged_lines=count_log_lines(scratch))
+        for name, r in sorted(results.items()): print(f"  {name:<48} {r['rps']:8.1f} req/s  statuses {r['statuses']}")
+        print(f"  drained in {drain:.1f}s; {meta['logged_lines']} narrative lines, {geo.requests} geolocation and {webhook.requests} webhook requests")
+        return finish(results, meta, args)
+    finally:
+        if proc is not None: stop_gunicorn(proc)
+        geo.close(); webhook.close()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+"""Micro-benchmarks for table resolution and history reads.
+
+    python -m bench.micro [--log-sizes 1k,10k,100k,1m] [--seed N] [--output results.json] [--baseline old.json]
+
+Synthetic narrative logs are generated from real resolved rolls; pass --log-dir to keep them between
+runs (a 10m-line log is several GB).
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+from app.history import first_line_tag, make_cursor, read_history
+from bench.common import CRIT_OPTIONS, FUMBLE_OPTIONS, add_output_arguments, crit_payload, finish, fumble_payload, metadata, roll_payload, time_calls
+
+SIZE_SUFFIXES = {"k": 1_000, "m": 1_000_000}
+
+
+def parse_size(text):
+    text = text.strip().lower()
+    return int(text[:-1]) * SIZE_SUFFIXES[text[-1]] if text[-1] in SIZE_SUFFIXES else int(text)
+
+
+def load_app(storage_dir):
+    # The app reads its log location at import time, so point it at scratch space first
+    os.environ["LOG_STORAGE_DIR"] = storage_dir
+    from app import app as app_module
+    app_module.app.logger.setLevel(logging.ERROR)
+    return app_module
+
+
+# --- Table resolution ---
+def bench_resolve_roll(app_module, rng, repeat):
+    results = {}
+    for kind, tables in (("crit", app_module.CRIT_TABLES), ("fumble", app_module.FUMBLE_TABLES)):
+        for source, by_key in sorted(tables.items()):
+            compiled = list(by_key.values())
+            cases = iter([(rng.randint(1, t.faces), t) for t in (rng.choice(compiled) for _ in range(repeat + 100))])
+            results[f"resolve_roll.{kind}.{source}"] = time_calls(lambda: app_module.resolve_roll(*next(cases)), repeat, batch=50)
+    return results
+
+
+def bench_resolve_payload(app_module, rng, seed, repeat):
+    results = {}
+    for name, make, options in (("crit", crit_payload, CRIT_OPTIONS), ("fumble", fumble_payload, FUMBLE_OPTIONS)):
+        for source in sorted(options):
+            payloads = iter([make(rng, source) for _ in range(repeat + 100)])
+            random.seed(seed)  # resolve_roll_payload draws its dice from the module RNG
+            results[f"resolve_payload.{name}.{source}"] = time_calls(lambda: app_module.resolve_roll_payload(next(payloads)), repeat, batch=10)
+    return results
+
+
+# --- History ---
+def build_log(app_module, path, lines, rng):
+    """Write `lines` narrative records built from real resolutions (a pool of 1000 distinct ones, repeated)."""
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            if sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1 << 20), b"")) == lines: return
+    pool = []
+    geo_info = {"city": "Benchton", "regionName": "Loadshire"}
+    for _ in range(1000):
+        payload = roll_payload(rng)
+        response = app_module.resolve_roll_payload(payload, rng.randint(1, app_module.die_faces_for(payload)))
+        narrative = app_module.compose_narrative(payload, response, rng.choice(app_module.RANDOM_DESCRIPTORS), geo_info)
+        # Everything after the timestamp; the real writer puts the timestamp first too
+        pool.append(json.dumps({"timestamp": "", "narrative": narrative, "raw_payload": payload, "raw_response": response})[len('{"timestamp": ""'):] + "\n")
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    with open(path, "w") as f:
+        for chunk_start in range(0, lines, 10_000):
+            f.write("".join(f'{{"timestamp": "{(start + datetime.timedelta(seconds=i)).isoformat()}"{pool[i % len(pool)]}'
+                            for i in range(chunk_start, min(lines, chunk_start + 10_000))))
+
+
+def middle_cursor(path):
+    with open(path, "rb") as f:
+        f.seek(os.path.getsize(path) // 2); f.readline()
+        return make_cursor(os.fstat(f.fileno()).st_ino, first_line_tag(f), f.tell())
+
+
+def bench_history(app_module, log_dir, sizes, rng, repeat):
+    results = {}
+    client = app_module.app.test_client()
+    for label in sizes:
+        lines = parse_size(label)
+        path = os.path.join(log_dir, f"narrative_{label}.jsonl")
+        print(f"Preparing {lines:,}-line log at {path}...", file=sys.stderr)
+        build_log(app_module, path, lines, rng)
+        cursor = middle_cursor(path)
+        results[f"history.{label}.latest"] = time_calls(lambda: read_history(path, [], limit=50), repeat)
+        results[f"history.{label}.page"] = time_calls(lambda: read_history(path, [], before=cursor, limit=50), repeat)
+        # The route as players hit it, including cursor parsing and JSON encoding
+        app_module.NARRATIVE_LOG_FILE_PATH = path
+        results[f"get_roll_history.{label}"] = time_calls(lambda: client.get("/get_roll_history?limit=50"), repeat)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for roll resolution and history reads.")
+    parser.add_argument("--log-sizes", default="1k,10k,100k,1m", help="comma-separated history log sizes, e.g. 1k,1m,10m")
+    parser.add_argument("--log-dir", help="keep generated logs here and reuse them on later runs")
+    parser.add_argument("--repeat", type=int, default=50000, help="calls per resolution benchmark (default 50000)")
+    parser.add_argument("--history-repeat", type=int, default=500, help="calls per history benchmark (default 500)")
+    parser.add_argument("--only", help="run only benchmarks whose name starts with this prefix")
+    add_output_arguments(parser)
+    args = parser.parse_args(argv)
+
+    scratch = tempfile.mkdtemp(prefix="crits-bench-")
+    try:
+        app_module = load_app(scratch)
+        sizes = [s.strip() for s in args.log_sizes.split(",") if s.strip()]
+        groups = [(("resolve_roll",), lambda rng: bench_resolve_roll(app_module, rng, args.repeat)),
+                  (("resolve_payload",), lambda rng: bench_resolve_payload(app_module, rng, args.seed, args.repeat)),
+                  (("history", "get_roll_history"), lambda rng: bench_history(app_module, args.log_dir or scratch, sizes, rng, args.history_repeat))]
+        results = {}
+        if args.log_dir: os.makedirs(args.log_dir, exist_ok=True)
+        for prefixes, run in groups:
+            if args.only and not any(p.startswith(args.only) or args.only.startswith(p) for p in prefixes): continue
+            results.update(run(random.Random(f"{args.seed}-{prefixes[0]}")))
+        if args.only: results = {k: v for k, v in results.items() if k.startswith(args.only)}
+        return finish(results, metadata(args.seed, suite="micro", log_sizes=sizes), args)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,32 @@
+# Loaded automatically by gunicorn from the working directory (see render.yaml).
+import os
+
+TABLE_FILES = [os.path.join(os.path.dirname(os.path.abspath(__file__)), "app", name)
+               for name in ("critical_hits_master.json", "fumbles_master.json")]
+_shared_state = None
+
+
+def on_starting(server):
+    # Set up shared memory in the master so every worker forked from it attaches to the same state
+    global _shared_state
+    from app.shared_state import prepare_shared_state
+    _shared_state = prepare_shared_state(TABLE_FILES)
+    server.log.info(f"Shared state at {_shared_state.path} ({_shared_state.size:,} bytes)")
+
+
+def post_worker_init(worker):
+    # On SIGTERM gthread waits up to graceful_timeout for open requests; end the live streams so they are not among them.
+    # The handler only starts a thread: taking the feed's lock inside a signal handler could deadlock.
+    import signal
+    import threading
+    from app.app import live_feed
+    handle_exit = worker.handle_exit
+
+    def stop(sig, frame):
+        threading.Thread(target=live_feed.close, name="live-feed-close", daemon=True).start()
+        handle_exit(sig, frame)
+    signal.signal(signal.SIGTERM, stop)
+
+
+def on_exit(server):
+    if _shared_state is not None: _shared_state.remove()